@@ -0,0 +1,131 @@
+"""
+Circuit breakers for quote sources.
+After failure_threshold failures in a row the breaker opens and its source is skipped for cooldown seconds,
+then one trial request is allowed (half open), success closes the breaker and failure opens it again.
+Symbols that failed are kept in a short lived negative cache and skipped until it expires.
+"""
+import threading
+import time
+
+from exceptions import logging, sys
+
+LOG = logging.getLogger('Circuit.Breaker.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+_lock = threading.Lock()
+_breakers = {}
+
+
+class NegativeCache:
+    def __init__(self, ttl: float = 600, clock=time.monotonic):
+        """
+        :param ttl: float, seconds a failed symbol is skipped.
+        :param clock: callable, seconds clock, for tests.
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._expires = {}
+
+    def add(self, key):
+        self._expires[key] = self.clock() + self.ttl
+
+    def __contains__(self, key) -> bool:
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+        if expires <= self.clock():
+            self._expires.pop(key, None)
+            return False
+        return True
+
+    def __len__(self):
+        return sum(1 for key in list(self._expires) if key in self)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 3, cooldown: float = 300, negative_ttl: float = 600,
+                 clock=time.monotonic):
+        """
+        :param name: str, quote source name, like 'bizportal'.
+        :param failure_threshold: int, failures in a row that open the breaker.
+        :param cooldown: float, seconds source is skipped after breaker opened.
+        :param negative_ttl: float, seconds a failed symbol is skipped.
+        :param clock: callable, seconds clock, for tests.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.negative_cache = NegativeCache(negative_ttl, clock)
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened_count = 0
+        self.rejected_count = 0
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            log = LOG.warning if state == OPEN else LOG.info
+            log(f'Circuit breaker {self.name}: {self.state} -> {state}')
+            self.state = state
+
+    def allow(self, symbol=None) -> bool:
+        """
+        :param symbol: symbol about to be requested, rejected if in negative cache.
+        :return: True if request to source may be sent.
+        """
+        with self._lock:
+            if symbol is not None and symbol in self.negative_cache:
+                self.rejected_count += 1
+                return False
+
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.cooldown:
+                    self.rejected_count += 1
+                    return False
+                self._set_state(HALF_OPEN)
+                return True
+
+            if self.state == HALF_OPEN:  # trial request already sent
+                self.rejected_count += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self, symbol=None):
+        """:param symbol: symbol that failed, added to negative cache."""
+        with self._lock:
+            if symbol is not None:
+                self.negative_cache.add(symbol)
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened_count += 1
+                self.opened_at = self.clock()
+                self._set_state(OPEN)
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened_count,
+                'rejected': self.rejected_count, 'negative_cached': len(self.negative_cache)}
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    """CircuitBreaker of quote source name for the process, created on first use"""
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def breakers_stats() -> dict:
+    with _lock:
+        return {name: breaker.stats() for name, breaker in _breakers.items()}
@@ -7,6 +7,33 @@ import sys
 TODAY = datetime.datetime.strftime(datetime.datetime.today(), '%d-%m-%Y')
 
 
+class CircuitOpenError(Exception):
+    """raised instead of sending request to quote source with open circuit breaker"""
+
+
+class PipelineError(Exception):
+    """raised when stages of a pipeline.Pipeline run failed"""
+
+
+class lazy_class_attribute:
+    """
+    Class attribute created by factory on first access and then stored on the class,
+    for objects that are slow to import or create, like database clients.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        value = self.factory()
+        setattr(owner, self.name, value)
+        return value
+
+
 def create_logger():
     if not os.path.isdir('logs'):
         os.mkdir('logs')
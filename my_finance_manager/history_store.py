@@ -0,0 +1,234 @@
+"""
+Columnar mirror of history_data collection, for history tables and analytics.
+Every column is a file, dates index (datetime64[D]) and float64 values,
+read back as memory-mapped arrays, so years of daily records load with no query and no copy.
+The mirror is built from MongoDB once, then sync writes only records from the last stored day,
+as today record is updated during the day.
+Every write makes a new generation folder of all files, then swaps the CURRENT pointer file to it,
+so readers in other processes, like the GUI while the schedule writes, always see columns of one generation.
+Writers take a lock file, and skip sync while the database revision is the one already mirrored.
+Records of earlier days, added or changed by imports or restores, change the collection fingerprint,
+count and sums of columns, and the mirror is built again.
+"""
+import contextlib
+import json
+import shutil
+import time
+
+import numpy as np
+
+from exceptions import logging, os, sys, datetime
+from price_history import DATES_DTYPE, read_memmap
+
+LOG = logging.getLogger('History.Store.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+VALUES_DTYPE = np.dtype(np.float64)
+HISTORY_COLUMNS = ('Portfolio_ILS', 'Portfolio_USD', 'Total_ILS', 'Total_USD', 'Profit_%', 'Profit_ILS',
+                   'Bank_CF', 'Trader_CF', 'Foreign_Currencies')
+
+
+class HistoryStore:
+    def __init__(self, path: str = 'media/history/mfm/', lock_timeout: float = 60):
+        """
+        :param path: str, folder of generations folders of one database, created on first write.
+        :param lock_timeout: float, seconds a lock file is kept before it counts as left by a crashed writer.
+        """
+        self.path = path
+        self.lock_timeout = lock_timeout
+
+    @property
+    def _current_file(self) -> str:
+        return os.path.join(self.path, 'CURRENT')
+
+    def _current(self) -> dict:
+        """:return: dict, generation number and mirrored database revision, empty if store was never written."""
+        try:
+            with open(self._current_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _folder(self, generation: int = None) -> str:
+        if generation is None:
+            generation = self._current().get('generation', 0)
+        return os.path.join(self.path, str(generation))
+
+    @staticmethod
+    def _file(folder: str, column: str) -> str:
+        return os.path.join(folder, f'{column.replace("%", "Percent")}.values')
+
+    @staticmethod
+    def _read(folder: str) -> tuple:
+        """:return: tuple, (dates, {column: values}) memory-mapped files of one generation folder."""
+        dates = read_memmap(os.path.join(folder, 'Date.dates'), DATES_DTYPE)
+        return dates, {column: read_memmap(HistoryStore._file(folder, column), VALUES_DTYPE, length=len(dates))
+                       for column in HISTORY_COLUMNS}
+
+    def dates(self) -> np.ndarray:
+        """:return: numpy datetime64[D] array, stored days, sorted."""
+        return self._read(self._folder())[0]
+
+    def column(self, column: str) -> np.ndarray:
+        """:return: numpy float64 array, value of column for every day in dates(), nan where missing."""
+        return self._read(self._folder())[1][column]
+
+    def last_date(self):
+        """:return: numpy datetime64[D] of last stored day, None if store is empty."""
+        dates = self.dates()
+        return dates[-1] if len(dates) else None
+
+    def frame(self, start=None, end=None, limit: int = None):
+        """
+        :param start: first day, date or 'YYYY-MM-DD', from first stored day if not given.
+        :param end: last day, included, to last stored day if not given.
+        :param limit: int, count of latest days in window, all of them if not given.
+        :return: pandas DataFrame, Date and HISTORY_COLUMNS of days between start and end, latest day first,
+                 columns are views of the memory-mapped files.
+        """
+        import pandas as pd
+
+        dates, values = self._read(self._folder())
+        i = np.searchsorted(dates, np.datetime64(start, 'D')) if start is not None else 0
+        j = np.searchsorted(dates, np.datetime64(end, 'D'), side='right') if end is not None else len(dates)
+        if limit:
+            i = max(i, j - limit)
+        columns = {'Date': dates[i:j][::-1]}
+        for column in HISTORY_COLUMNS:
+            columns[column] = values[column][i:j][::-1]
+        return pd.DataFrame(columns, copy=False)
+
+    def fingerprint(self) -> dict:
+        """:return: dict, count of days and sum of every column, nan values count as 0, like history_data."""
+        dates, values = self._read(self._folder())
+        return {'count': len(dates), **{column: float(np.nansum(values[column])) for column in HISTORY_COLUMNS}}
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """lock file of store folder, so one process writes at a time"""
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = os.path.join(self.path, 'LOCK')
+        while True:
+            try:
+                os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > self.lock_timeout:
+                        LOG.warning(f'Removing lock file older than {self.lock_timeout}s, {lock_file}')
+                        os.remove(lock_file)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.remove(lock_file)
+
+    def _publish(self, dates: np.ndarray, values: dict, revision: int = None):
+        """write a new generation, swap CURRENT to it, and remove generations readers no longer start on"""
+        current = self._current()
+        generation = current.get('generation', 0) + 1
+        folder = self._folder(generation)
+        shutil.rmtree(folder, ignore_errors=True)  # left by an interrupted write
+        os.makedirs(folder)
+        for column in HISTORY_COLUMNS:
+            np.asarray(values[column], dtype=VALUES_DTYPE).tofile(self._file(folder, column))
+        np.asarray(dates, dtype=DATES_DTYPE).tofile(os.path.join(folder, 'Date.dates'))
+        self._set_current(generation, revision)
+
+        # previous generation is kept, a reader may have read CURRENT just before the swap.
+        for name in os.listdir(self.path):
+            if name.isdigit() and int(name) < generation - 1:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)  # still mapped on windows
+
+    def _set_current(self, generation: int, revision: int = None):
+        temp_file = f'{self._current_file}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'generation': generation, 'revision': revision}, f)
+        for attempt in range(20):
+            try:
+                os.replace(temp_file, self._current_file)
+                return
+            except PermissionError:  # windows does not replace a file while a reader has it open
+                if attempt == 19:
+                    raise
+                time.sleep(0.05)
+
+    @staticmethod
+    def _values(records: list, column: str) -> np.ndarray:
+        return np.array([np.nan if record.get(column) is None else record[column] for record in records],
+                        dtype=VALUES_DTYPE)
+
+    def _upsert(self, records, revision: int = None) -> int:
+        last = self.last_date()
+        records = sorted((record for record in records
+                          if last is None or np.datetime64(record['Date'], 'D') >= last),
+                         key=lambda record: record['Date'])
+        if not records:
+            return 0
+
+        dates, values = self._read(self._folder())
+        row = len(dates)
+        if last is not None and np.datetime64(records[0]['Date'], 'D') == last:
+            row -= 1
+        new_dates = np.array([record['Date'] for record in records], dtype='datetime64[ms]').astype(DATES_DTYPE)
+        self._publish(np.concatenate([dates[:row], new_dates]),
+                      {column: np.concatenate([values[column][:row], self._values(records, column)])
+                       for column in HISTORY_COLUMNS}, revision)
+        return len(records)
+
+    def _rebuild(self, records, revision: int = None) -> int:
+        records = sorted(records, key=lambda record: record['Date'])
+        self._publish(np.array([record['Date'] for record in records], dtype='datetime64[ms]').astype(DATES_DTYPE),
+                      {column: self._values(records, column) for column in HISTORY_COLUMNS}, revision)
+        return len(records)
+
+    def upsert(self, records) -> int:
+        """
+        Store records of days from the last stored day, it is replaced, earlier days are ignored.
+        :param records: iterable of dicts with Date and HISTORY_COLUMNS keys, like _HistoryData.fetch_data_for_df.
+        :return: int, written days count.
+        """
+        with self._write_lock():
+            return self._upsert(records)
+
+    def rebuild(self, records) -> int:
+        """Replace stored days with records, for changes of past days in MongoDB. :return: int, days count."""
+        with self._write_lock():
+            return self._rebuild(records)
+
+    def _in_sync(self, history_data) -> bool:
+        mirror, collection = self.fingerprint(), history_data.fingerprint(HISTORY_COLUMNS)
+        return mirror['count'] == collection['count'] and \
+            np.allclose([mirror[column] for column in HISTORY_COLUMNS],
+                        [collection[column] for column in HISTORY_COLUMNS], rtol=1e-9, atol=1e-6)
+
+    def sync(self, history_data, revision: int = None) -> int:
+        """
+        :param history_data: mongo_db._HistoryData.
+        :param revision: int, database revision read before sync, nothing is read while mirror has this revision.
+        :return: int, written days count, the whole collection on first sync or when mirror differs from it.
+        """
+        if revision is not None and self._current().get('revision') == revision:
+            return 0
+
+        with self._write_lock():
+            current = self._current()
+            if revision is not None and current.get('revision') == revision:  # synced by another process
+                return 0
+
+            last = self.last_date()
+            if last is not None:
+                written = self._upsert(history_data.fetch_data_for_df(
+                    start=datetime.datetime.combine(last.astype(datetime.date), datetime.time())), revision)
+                if self._in_sync(history_data):
+                    if not written:  # mirror was in sync, it now has the revision
+                        self._set_current(current['generation'], revision)
+                    return written
+
+            written = self._rebuild(history_data.fetch_data_for_df(), revision)
+            LOG.info(f'History store built, {written} days')
+            return written
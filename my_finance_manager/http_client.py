@@ -0,0 +1,143 @@
+"""
+Process-wide HTTP client for quote and FX sources.
+One requests session with keep-alive connection pools of bounded size and retries with exponential backoff,
+so every request to the same host after the first reuses an open connection.
+Counters show requests, new connections and connection reuse ratio of sync and asyncio requests.
+"""
+import asyncio
+import concurrent.futures
+import threading
+
+from exceptions import logging, sys
+
+LOG = logging.getLogger('HTTP.Client.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+_lock = threading.Lock()
+_shared_client = None
+
+
+class HttpClient:
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size: int = 10, retries: int = 3, backoff_factor: float = 0.5, timeout: float = 10):
+        """
+        :param pool_size: int, max open connections per host, requests wait for a free connection.
+        :param retries: int, retries of failed connections and RETRY_STATUSES responses.
+        :param backoff_factor: float, retry n waits backoff_factor * 2 ** (n - 1) seconds.
+        :param timeout: float, default seconds for each request.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeout = timeout
+        self.retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                           raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True,
+                                   max_retries=self.retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self._html_session = None
+        self._render_executor = None
+        self._counters_lock = threading.Lock()
+        self.requests_count = 0
+        self.async_new_connections = 0
+
+    def get(self, url: str, **kwargs):
+        """requests.Session.get with client default timeout, raises for error statuses"""
+        kwargs.setdefault('timeout', self.timeout)
+        self.count_request()
+        r = self.session.get(url, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def html_session(self):
+        """one requests_html session for the process, so the headless browser is launched once"""
+        with _lock:
+            if self._html_session is None:
+                from requests_html import HTMLSession
+                self._html_session = HTMLSession()
+                self._html_session.mount('http://', self.adapter)
+                self._html_session.mount('https://', self.adapter)
+        return self._html_session
+
+    def render(self, url: str):
+        """
+        Get url with the html session and render its javascript with the headless browser.
+        Rendering runs on one thread of the client with its own event loop, so it can be called from pool threads,
+        and the browser is launched without signal handlers, which only the main thread can install.
+        :return: requests_html HTML of rendered page.
+        """
+        with _lock:
+            if self._render_executor is None:
+                self._render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                              thread_name_prefix='html-render')
+        return self._render_executor.submit(self._render, url).result()
+
+    def _render(self, url: str):
+        session = self.html_session()
+        if not hasattr(session, '_browser'):  # HTMLSession.browser would use the event loop of main thread
+            import pyppeteer
+
+            session.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(session.loop)
+            session._browser = session.loop.run_until_complete(pyppeteer.launch(
+                headless=True, args=['--no-sandbox'], handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False))
+            LOG.debug('Headless browser launched')
+        r = session.get(url)
+        r.html.render()
+        return r.html
+
+    def count_request(self, new_connection: bool = False):
+        """count request, asyncio requests also report if they opened a new connection"""
+        with self._counters_lock:
+            self.requests_count += 1
+            self.async_new_connections += int(new_connection)
+
+    def aiohttp_trace_config(self):
+        """aiohttp TraceConfig that reports asyncio requests and their new connections to this client"""
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            self.count_request()
+
+        async def on_connection_create_end(session, context, params):
+            with self._counters_lock:
+                self.async_new_connections += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def stats(self) -> dict:
+        """
+        :return: dict, requests, new_connections and reuse_ratio, part of requests that used an open connection.
+        """
+        pools = self.adapter.poolmanager.pools
+        new_connections = sum(pools[key].num_connections for key in pools.keys()) + self.async_new_connections
+        reuse_ratio = 1 - new_connections / self.requests_count if self.requests_count else 0.0
+        return {'requests': self.requests_count, 'new_connections': new_connections,
+                'reuse_ratio': max(reuse_ratio, 0.0)}
+
+    def close(self):
+        self.session.close()
+        if self._render_executor is not None:  # browser is closed on the event loop of render thread
+            self._render_executor.submit(self._html_session.close).result()
+            self._render_executor.shutdown()
+        elif self._html_session is not None:
+            self._html_session.close()
+
+
+def shared_client() -> HttpClient:
+    """HttpClient of the process, created on first use"""
+    global _shared_client
+    with _lock:
+        if _shared_client is None:
+            _shared_client = HttpClient()
+            LOG.debug('Shared HTTP client created')
+    return _shared_client
@@ -10,37 +10,67 @@ __version__ = '1.1'
 # 1.1 MongoDB version + ThreadPoolExecutor for schedule script
 
 
-import matplotlib.pyplot as plt
+import collections
+
+# heavy dependencies (pandas, matplotlib, selenium, requests_html, yagmail, tabulate, yfinance, forex_python)
+# are imported on first use, so entry points that only read from database start fast.
 import numpy as np
-import pandas as pd
-import requests
-import yagmail
-import yfinance as yf
-from forex_python.converter import CurrencyRates, CurrencyCodes
-from matplotlib import cm as cm
-from requests_html import HTMLSession
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from tabulate import tabulate
 
 import mongo_db
+from circuit_breaker import circuit_breaker, breakers_stats
+from http_client import shared_client
+from history_store import HistoryStore
+from price_history import PriceHistoryStore
+from quote_cache import shared_cache
+from rate_limiter import rate_limiter, limiters_stats
+from quotes import YahooQuoteProvider, BizPortalQuoteProvider, FxSnapshot, QuoteRouter
 from config.config import sender_password, sender_email
-from exceptions import create_logger, os, datetime
+from exceptions import create_logger, lazy_class_attribute, os, datetime, CircuitOpenError
+
+
+def _currency_rates():
+    from forex_python.converter import CurrencyRates
+    return CurrencyRates()
+
+
+def _currency_codes():
+    from forex_python.converter import CurrencyCodes
+    return CurrencyCodes()
 
 
 class MyFinanceManager:
     LOG = create_logger()
     TODAY = mongo_db.TODAY
-    CR = CurrencyRates()
-    CC = CurrencyCodes()
+    CR = lazy_class_attribute(_currency_rates)
+    CC = lazy_class_attribute(_currency_codes)
+    quote_provider = YahooQuoteProvider(cache=shared_cache())
+    redemption_provider = BizPortalQuoteProvider(cache=shared_cache())
 
     graphs_save_path = 'media/graphs/'
     days_left = 0  # for changing Meitav Dash website password
 
-    def __init__(self):
+    def __init__(self, quote_provider=None, redemption_provider=None, derived_on_read: bool = None):
+        """
+        :param derived_on_read: bool, keep latest prices in quotes collection and compute lots values on read,
+                                saved in database, see mongo_db.MyMongoDB.
+        """
         self.LOG.debug('Initializing MFM object')
 
-        self.db = mongo_db.MyMongoDB()
+        self.db = mongo_db.MyMongoDB(derived_on_read=derived_on_read)
+        if quote_provider:
+            self.quote_provider = quote_provider
+        if redemption_provider:
+            self.redemption_provider = redemption_provider
+        self.fx = None  # FxSnapshot of last refresh
+        # fund requests race BizPortal API against Maya website when BizPortal is slower than usual.
+        self.redemption_router = QuoteRouter({'bizportal': self._provider_redemption_price,
+                                              'maya': self._maya_redemption_price})
+        self.price_history = PriceHistoryStore(source=self.quote_provider)
+
+        if self.db.mode_changed:  # quotes are seeded for derived on read mode, lots are revalued for stored mode
+            self.LOG.info(f'Lots storage mode changed, derived on read: {self.db.stocks.derived_on_read}')
+            self.update_stocks_price()
+            self.db.totals.recompute()
 
         if not os.path.exists(self.graphs_save_path):  # creating Graphs folder in root dir for future graphs generate.
             self.LOG.debug('Trying to create Graphs folder')
@@ -59,6 +89,23 @@ class MyFinanceManager:
         date_string = date_string.strip().replace('.', '/').replace('\\', '/')
         return datetime.datetime.strptime(date_string, '%d/%m/%Y')
 
+    def refresh_fx(self, currencies=()) -> FxSnapshot:
+        """
+        Fetch USD/ILS and currency lots rates to ILS once, all conversions of a refresh are done against this snapshot.
+        :param currencies: iterable of str, more currencies to get rates to ILS for, like 'EUR'.
+        """
+        currencies = {c.upper() for c in currencies} | set(self.db.stocks.get_currency_indexes())
+        pairs = [('USD', 'ILS')] + [(c, 'ILS') for c in sorted(currencies - {'USD', 'ILS'})]
+        self.fx = FxSnapshot.fetch(self.CR, pairs=pairs, cache=shared_cache())
+        return self.fx
+
+    def _fx_rate(self, i_have: str, i_want: str) -> float:
+        """rate from the last FX snapshot, refreshed if there is none or it has no rate of the currencies"""
+        try:
+            return (self.fx or self.refresh_fx()).rate(i_have, i_want)
+        except KeyError:
+            return self.refresh_fx(currencies=[i_have, i_want]).rate(i_have, i_want)
+
     @classmethod
     def currency_converter(cls, i_have: str = None, i_want: str = None, amount=.0,
                            symbol: str = None) -> float or str:
@@ -99,119 +146,98 @@ class MyFinanceManager:
         :param tase_index: int, if israeli stock (Tel-Aviv Stock Exchange).
         :return: True
         """
-
-        if (currency is 'USD' and tase_index != 0) or (currency is 'ILS' and tase_index == 0):
-            raise ValueError
-
-        # convert date to datetime object
-        if date.strip().lower() == 'today':
-            date = datetime.datetime.today()
-        else:
-            date = self._convert_to_datetime_obj(date)
-
-        symbol = symbol.upper().strip()
-        currency = currency.upper().strip()
-
-        symbol_current_lots_count = self.db.stocks.get_stock_lots_count(symbol)
-        if symbol_current_lots_count > 1:
-            lot_num = symbol_current_lots_count + 1
-        else:
-            lot_num = 1
-
-        d = {'symbol': symbol}
-        if currency == 'USD':
-            start_market_val = buy_price * amount
-            current_market_val = self.get_stock_price(symbol) * amount
-            converted_c_market_val = np.round(self.CR.convert('USD', 'ILS', current_market_val), 3)
-
-            profit_usd = np.round(current_market_val - start_market_val, 3)
-            profit_ils = np.round(self.CR.convert('USD', 'ILS', profit_usd), 3)
-            profit_percentage = np.round((((current_market_val / start_market_val) * 100) - 100), 3)
-
-            d.update({
-                'Lot_Num': lot_num,
-                'Date': date,
-                'Amount': amount,
-                'Buy_Price': buy_price,
-                'Currency': currency,
-                'Market_Value USD': current_market_val,
-                'Market_Value ILS': converted_c_market_val,
-                'Profit_USD': profit_usd,
-                'Profit_ILS': profit_ils,
-                'Profit_%': profit_percentage,
-            })
-
-        elif currency == 'ILS':
-            start_market_val = (buy_price * amount) / 100
-            current_market_val = (self.get_redemption_price(tase_index) * amount) / 100
-            converted_c_market_val = np.round(self.CR.convert('ILS', 'USD', current_market_val), 3)
-
-            profit_ils = np.round(current_market_val - start_market_val, 3)
-            profit_usd = np.round(self.CR.convert('ILS', 'USD', profit_ils), 3)
-            profit_percentage = np.round((((current_market_val / start_market_val) * 100) - 100), 3)
-
-            d.update({
-                'Lot_Num': lot_num,
-                'Date': date,
-                'Amount': amount,
-                'Buy_Price': buy_price,
-                'Currency': currency,
-                'Market_Value_USD': converted_c_market_val,
-                'Market_Value_ILS': current_market_val,
-                'Profit_USD': profit_usd,
-                'Profit_ILS': profit_ils,
-                'TASE_INDEX': tase_index,
-                'Profit_%': profit_percentage,
-            })
-
-        self.db.stocks.insert_stock(d)
+        self.add_stocks([{'symbol': symbol, 'date': date, 'amount': amount, 'buy_price': buy_price,
+                          'currency': currency, 'tase_index': tase_index}])
         self.LOG.info(f'{symbol} added to portfolio')
         return True
 
-    def _loop_update_stock(self, symbol, lot_count):
-        for lot_num in range(1, lot_count + 1):
-            if self.db.stocks.get_field_from_stock(symbol, lot_num, 'Currency') == 'ILS':
-                amount = self.db.stocks.get_field_from_stock(symbol, lot_num, 'Amount')
-                buy_price = self.db.stocks.get_field_from_stock(symbol, lot_num, 'Buy_Price')
-                start_market_val = (buy_price * amount) / 100
-
-                tase_index = self.db.stocks.get_field_from_stock(symbol, lot_num, 'TASE_INDEX')
-                updated_buy_price = self.get_redemption_price(tase_index)
-
-                current_market_val = (updated_buy_price * amount) / 100
-                converted_c_market_val = np.round(self.CR.convert('ILS', 'USD', current_market_val), 3)
+    def _new_lot(self, symbol: str, date, amount: int, buy_price: float, currency: str,
+                 tase_index: int or str = 0) -> dict:
+        """validated and normalized lot purchase data, date is 'today', full date string or datetime"""
+        symbol = symbol.upper().strip()
+        currency = currency.upper().strip()
+        tase_index = tase_index or 0
+        if currency not in ('USD', 'ILS') or (currency == 'USD' and tase_index != 0) or \
+                (currency == 'ILS' and tase_index == 0):
+            raise ValueError(f'{symbol}: {currency} lot with TASE index {tase_index}')
 
-                profit_ils = np.round(current_market_val - start_market_val, 3)
-                profit_usd = np.round(self.CR.convert('ILS', 'USD', profit_ils), 3)
-                profit_percentage = np.round((((current_market_val / start_market_val) * 100) - 100), 3)
+        # convert date to datetime object
+        if isinstance(date, str):
+            if date.strip().lower() == 'today':
+                date = datetime.datetime.today()
+            else:
+                date = self._convert_to_datetime_obj(date)
 
-                self.db.stocks.update_stock_lot(symbol, lot_num, current_market_val, converted_c_market_val,
-                                                profit_usd, profit_ils, profit_percentage)
+        lot = {'symbol': symbol, 'Date': date, 'Amount': amount, 'Buy_Price': float(buy_price), 'Currency': currency}
+        if currency == 'ILS':
+            lot['TASE_INDEX'] = tase_index
+        return lot
 
-            else:
-                amount = self.db.stocks.get_field_from_stock(symbol, lot_num, 'Amount')
-                buy_price = self.db.stocks.get_field_from_stock(symbol, lot_num, 'Buy_Price')
-                start_market_val = buy_price * amount
+    def add_stocks(self, lots) -> int:
+        """
+        Add many lots to portfolio, every distinct symbol is priced once and all lots are inserted together.
+        Lot numbers are reserved from per symbol counters, so concurrent adds never get the same number.
+        :param lots: iterable of dicts with add_stock arguments, symbol, date, amount, buy_price, currency
+                     and tase_index for israeli stocks.
+        :return: int, lots added.
+        :raise: ValueError if a lot is invalid or has no price, nothing is added.
+        """
+        import revaluation
+
+        docs = [self._new_lot(**lot) for lot in lots]
+        if not docs:
+            return 0
+
+        fx = self.refresh_fx()  # before redemption prices, currency lots are priced from it
+        usd_prices = self.quote_provider.get_prices({d['symbol'] for d in docs if d['Currency'] == 'USD'})
+        ils_prices = self._get_redemption_prices({d['TASE_INDEX'] for d in docs if d['Currency'] == 'ILS'})
+        missing = sorted({d['symbol'] for d in docs
+                          if d['symbol'] not in usd_prices and d.get('TASE_INDEX') not in ils_prices})
+        if missing:
+            raise ValueError(f'No price for {", ".join(missing)}, no lots added')
+
+        first_lot_nums = self.db.lot_counters.reserve(collections.Counter(d['symbol'] for d in docs))
+        for d in docs:
+            d['Lot_Num'] = first_lot_nums[d['symbol']]
+            first_lot_nums[d['symbol']] += 1
+
+        frame = revaluation.lots_frame([mongo_db.Lot(d['symbol'], d['Lot_Num'], d['Currency'], d['Amount'],
+                                                     d['Buy_Price'], d.get('TASE_INDEX')) for d in docs])
+        if self.db.stocks.derived_on_read:  # values are computed on read from quotes collection
+            self.db.quotes.update_quotes(revaluation.quote_records(frame, usd_prices, ils_prices),
+                                         fx.rate('USD', 'ILS'))
+        else:
+            revalued = revaluation.revalue(frame, usd_prices, ils_prices, fx)
+            for d, values in zip(docs, revalued[revaluation.REVALUED_COLUMNS].to_dict('records')):
+                d.update(values)
 
-                updated_buy_price = self.get_stock_price(symbol)
+        added = self.db.stocks.insert_stocks(docs)
+        self.db.last_modified.update_field(field_name='stocks')
+        return added
 
-                current_market_val = updated_buy_price * amount
-                converted_c_market_val = np.round(self.CR.convert('USD', 'ILS', current_market_val), 3)
+    def update_stocks_price(self, symbol: str = None) -> bool:
+        import revaluation
 
-                profit_usd = np.round(current_market_val - start_market_val, 3)
-                profit_ils = np.round(self.CR.convert('USD', 'ILS', profit_usd), 3)
-                profit_percentage = np.round((((current_market_val / start_market_val) * 100) - 100), 3)
+        # one query for all lots, and one batched quote request for every distinct USD symbol.
+        lots = revaluation.lots_frame(self.db.stocks.load_lots([symbol] if symbol else None))
+        fx = self.refresh_fx()  # before redemption prices, currency lots are priced from it
+        usd_prices = self.quote_provider.get_prices(lots.symbol[lots.currency == 'USD'].unique())
+        ils_prices = self._get_redemption_prices(lots.tase_index[lots.currency == 'ILS'].unique())
 
-                self.db.stocks.update_stock_lot(symbol, lot_num, converted_c_market_val, current_market_val,
-                                                profit_usd, profit_ils, profit_percentage)
+        if self.db.stocks.derived_on_read:  # one write per symbol, lots are revalued on read
+            quotes = revaluation.quote_records(lots, usd_prices, ils_prices)
+            self.db.quotes.update_quotes(quotes, fx.rate('USD', 'ILS'))
+        else:
+            revalued = revaluation.revalue(lots, usd_prices, ils_prices, fx)
+            self.db.stocks.update_stock_lots(revalued.to_dict('records'))
+        self.LOG.info(f'HTTP client stats: {shared_client().stats()}, quote cache: {shared_cache().stats()}')
+        self.LOG.info(f'Quote sources circuit breakers: {breakers_stats()}')
+        self.LOG.info(f'Quote sources rate limiters queue wait: {limiters_stats()}')
+        self.LOG.info(f'Redemption price sources latency: {self.redemption_router.stats()}')
 
-    def update_stocks_price(self, symbol: str = None) -> bool:
         if symbol:
-            self._loop_update_stock(symbol, self.db.stocks.get_stock_lots_count(symbol))
             self.LOG.info(f'{symbol} price updated')
         else:
-            for d in self.db.stocks.get_stock_lots_count(per_stock=True):
-                self._loop_update_stock(d['symbol'], d['count'])
             self.LOG.info('All stocks prices updated')
 
         self.db.last_modified.update_field(field_name='stocks')
@@ -220,13 +246,13 @@ class MyFinanceManager:
     def update_bank_trader_foreign_currency(self, symbol: str,
                                             u_bank_usd_val: float = None, u_trader_usd_val: float = None):
         if u_trader_usd_val:
-            converted_trader_usd_val = self.currency_converter(symbol, 'ILS', u_trader_usd_val)
+            converted_trader_usd_val = u_trader_usd_val * self._fx_rate(symbol, 'ILS')
             self.db.foreign_currencies.update_foreign_currency(symbol, 'Trader', converted_trader_usd_val,
                                                                u_trader_usd_val)
             self.LOG.info('Trader Foreign Currency updated')
 
         elif u_bank_usd_val:
-            converted_bank_usd_val = self.currency_converter('ILS', symbol, u_bank_usd_val)
+            converted_bank_usd_val = u_bank_usd_val * self._fx_rate('ILS', symbol)
             self.db.foreign_currencies.update_foreign_currency(symbol, 'Bank', u_bank_usd_val, converted_bank_usd_val)
             self.LOG.info('Bank Foreign Currency updated')
 
@@ -244,81 +270,95 @@ class MyFinanceManager:
         return True
 
     def update_history_data(self):
-        total_profit = self.total_profit(numbers_only=True)
-        total_assets_ils = self.total_assets()
-        total_assets_usd = self.total_assets(in_usd=True)
+        # daily full recompute of portfolio totals, catches drift of the incrementally kept totals.
+        self.db.totals.check_drift()
+        fx = self.refresh_fx()
+        summary = self.db.portfolio_summary()
+        total_profit = self.total_profit(numbers_only=True, summary=summary)
+        total_assets_ils = self.total_assets(summary=summary)
+        total_assets_usd = self.total_assets(in_usd=True, fx=fx, summary=summary)
 
         self.db.history_data.update_all(
             total_profit=total_profit, total_assets_ils=total_assets_ils,
             total_assets_usd=total_assets_usd
         )
+        self.history_store.sync(self.db.history_data, revision=self.db.read_revision())
         return True
 
     def remove_stock(self, symbol: str, sell_amount: int):
         """
         Removes stock's shares by FIFO; first lot to came it - first to come out.
-        ** works recursively.
+        All sold lots are removed with one database write, then lots left are repriced once.
         """
-        lot_count = self.db.stocks.get_stock_lots_count(symbol)
-
-        for lot_num in range(1, lot_count + 1):
-            current_amount = self.db.stocks.get_field_from_stock(symbol, lot_num, 'Amount')
-
-            if current_amount > sell_amount:
-                self.db.stocks.update_stock_amount(symbol, lot_num, sell_amount)
-                self.LOG.info(f'{sell_amount} shares of {symbol} removed from lot {lot_num}')
-                return self.update_stocks_price(symbol)
-
-            elif current_amount < sell_amount:
-                new_amount = sell_amount - current_amount
-                self.db.stocks.remove_stock(symbol, lot_num)
-                self.LOG.info(f'{sell_amount} shares of {symbol} removed from lot {lot_num}')
-                return self.remove_stock(symbol, new_amount)
-
-            elif current_amount == sell_amount:
-                if self.db.stocks.get_stock_lots_count(symbol) > 1:  # if more than 1 lot remove only first lot
-                    self.db.stocks.remove_stock(symbol, lot_num)
-                    self.LOG.info(f'{sell_amount} shares of {symbol} removed from lot {lot_num}')
-                else:  # if only 1 lot remove the symbol from stocks db
-                    self.db.stocks.remove_stock(symbol)
-                    self.LOG.info(f'{symbol} removed from portfolio')
-                return self.update_stocks_price(symbol)
+        lots_left = self.db.stocks.sell_lots(symbol, sell_amount)
+        self.LOG.info(f'{sell_amount} shares of {symbol} removed, {lots_left} lots left')
+
+        if not lots_left:
+            self.LOG.info(f'{symbol} removed from portfolio')
+            self.db.last_modified.update_field(field_name='stocks')
+        elif not self.db.stocks.derived_on_read:  # lots left are valued at current prices
+            self.update_stocks_price(symbol)
+        return True
 
-    def get_redemption_price(self, fund_id: int) -> float:
+    @property
+    def history_store(self) -> HistoryStore:
+        """columnar mirror of history_data, a folder per database, so tests do not sync into the real mirror"""
+        return HistoryStore(os.path.join('media', 'history', self.db.history_data.collection.database.name, ''))
 
+    def _get_redemption_prices(self, fund_ids) -> dict:
+        """
+        Redemption prices of distinct funds fetched concurrently through redemption_router,
+        currency indexes go through get_redemption_price, funds with no price from any source are left out.
+        """
+        fund_ids = set(fund_ids)
+        prices = self.redemption_router.get_prices(f for f in fund_ids if not isinstance(f, str))
+        for fund_id in (f for f in fund_ids if isinstance(f, str)):
+            try:
+                prices[fund_id] = self.get_redemption_price(fund_id)
+            except Exception:
+                self.LOG.error(f'No redemption price for {fund_id}, its lots keep last values')
+        return prices
+
+    def get_redemption_price(self, fund_id: int) -> float:
         if isinstance(fund_id, str):
-            return np.round(self.currency_converter(fund_id, 'ILS') * 100, 3)
+            return np.round(self._fx_rate(fund_id, 'ILS') * 100, 3)
+        return self.redemption_router.get_price(fund_id)
+
+    def _provider_redemption_price(self, fund_id: int) -> float:
+        """primary source of redemption_router, redemption_provider with its cache and circuit breaker"""
+        price = self.redemption_provider.get_prices([fund_id]).get(fund_id)
+        if price is None:
+            raise LookupError(f'No redemption price for {fund_id} from {type(self.redemption_provider).__name__}')
+        return price
+
+    def _maya_redemption_price(self, fund_id: int) -> float:
+        # rendering starts a headless browser, so it is skipped while maya source keeps failing.
+        maya = circuit_breaker('maya')
+        if not maya.allow(fund_id):
+            raise CircuitOpenError(f'Maya website skipped for {fund_id}')
 
         try:
-            self.LOG.debug(f'Getting redemption price for {fund_id} with BizPortal API')
+            self.LOG.debug(f'Getting redemption price for {fund_id} with HTMLSession')
+            url = f'https://maya.tase.co.il/fund/{fund_id}'
+            rate_limiter('maya').acquire()
+            html = shared_client().render(url)  # router calls sources from pool threads
+            red_price = float(html.find('div.redemptionPriceValue.ng-binding')[0].text.split(' ')[0])
+            maya.record_success()
+            return red_price
 
-            url = f'http://externalapi.bizportal.co.il/mobile/m/GetQuote?id={fund_id}'
-            with requests.get(url) as r:
-                red_price = r.json()['Quote']['RedPrice']
-            return float(red_price)
-
-        except:
-            self.LOG.exception(f'Error while trying to get redemption price from BizPortal API')
-
-            try:
-                self.LOG.debug(f'Getting redemption price for {fund_id} with HTMLSession')
-                session = HTMLSession()
-                url = 'https://maya.tase.co.il/fund/5109889'
-                r = session.get(url)
-                r.html.render()
-                red_price = r.html.find('div.redemptionPriceValue.ng-binding')[0].text.split(' ')[0]
-                return float(red_price)
-
-            except Exception:
-                self.LOG.exception(f'Error while trying to get redemption price with HTMLSession')
-                raise
+        except Exception:
+            self.LOG.exception(f'Error while trying to get redemption price with HTMLSession')
+            maya.record_failure(fund_id)
+            raise
 
     def scrap_redemption_price(self, fund_num_exchange: int) -> float:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
 
         self.LOG.info(f'start web scrap for {fund_num_exchange} with web driver')
 
         if isinstance(fund_num_exchange, str):
-            return np.round(self.currency_converter(fund_num_exchange, 'ILS') * 100, 3)
+            return np.round(self._fx_rate(fund_num_exchange, 'ILS') * 100, 3)
 
         try:
             url = f'https://maya.tase.co.il/fund/{fund_num_exchange}'
@@ -328,6 +368,7 @@ class MyFinanceManager:
             c_options.add_argument("--log-level=3")
 
             driver = webdriver.Chrome(options=c_options)
+            rate_limiter('maya').acquire()
             driver.get(url)
 
             price = driver.find_element_by_class_name('redemptionPriceValue.ng-binding').text.split()[0]
@@ -339,13 +380,24 @@ class MyFinanceManager:
             self.LOG.exception(f'Error while trying to web scrap redemption price with web driver')
             raise e
 
-    @staticmethod
-    def get_stock_price(symbol: str) -> float:
-        stock = yf.Ticker(symbol)
-        stock_price = stock.history(period='1d').iloc[0, 3]
-        return float(stock_price)
+    def get_stock_price(self, symbol: str, date: datetime.date = None) -> float:
+        """
+        :param date: datetime.date, close of past day from local price history, last price if not given.
+        """
+        if date is not None and date < datetime.date.today():
+            self.price_history.sync([symbol])
+            return self.price_history.close_on(symbol, date)
+        return self.quote_provider.get_prices([symbol])[symbol]
 
+    def sync_price_history(self) -> dict:
+        """Download daily closes of USD stocks missing from local price history."""
+        return self.price_history.sync(self.db.stocks.get_stocks_names(currency='USD'))
+
+    @mongo_db.revision_cached
     def df_stocks(self, to_email: bool = False):
+        import pandas as pd
+        from tabulate import tabulate
+
         data = self.db.stocks.fetch_data_for_df()
         data.extend(self.db.foreign_currencies.fetch_data_for_df())
         df = pd.DataFrame(data=[d for d in data])
@@ -369,21 +421,21 @@ class MyFinanceManager:
         else:
             return df
 
-    def total_profit(self, numbers_only: bool = False) -> tuple:
+    @mongo_db.revision_cached
+    def total_profit(self, numbers_only: bool = False, summary: dict = None) -> tuple:
+        """:param summary: dict, from MyMongoDB.portfolio_summary, fetched if not given."""
         try:
-            total_profit_percentage = (((
-                                                self.db.stocks.sum_portfolio_field('Market_Value_ILS')
-                                                + self.db.stocks.sum_portfolio_field('Profit_ILS')
-                                        )
-                                        / self.db.stocks.sum_portfolio_field('Market_Value_ILS')
+            summary = summary or self.db.portfolio_summary()
+            total_profit_percentage = (((summary['Market_Value_ILS'] + summary['Profit_ILS'])
+                                        / summary['Market_Value_ILS']
                                         )
                                        * 100
                                        ) - 100
 
             if numbers_only:
-                return total_profit_percentage, self.db.stocks.sum_portfolio_field('Profit_ILS')
+                return total_profit_percentage, summary['Profit_ILS']
             else:
-                return f'{total_profit_percentage:,.4f}', f'{self.db.stocks.sum_portfolio_field("Profit_ILS"):,.2f}'
+                return f'{total_profit_percentage:,.4f}', f'{summary["Profit_ILS"]:,.2f}'
 
         except Exception:
             if numbers_only:
@@ -391,61 +443,66 @@ class MyFinanceManager:
             else:
                 return '0.0', '0.0'
 
-    def df_history(self, tabulate_output: bool = False, to_email: bool = False):
-        data = self.db.history_data.fetch_data_for_df()
-        df = pd.DataFrame(data=[d for d in data])
+    @mongo_db.revision_cached
+    def df_history(self, tabulate_output: bool = False, to_email: bool = False, start=None, end=None):
+        """
+        :param to_email: bool, last week stats only.
+        :param start: first day, date or 'YYYY-MM-DD', from first record if not given.
+        :param end: last day, included, to last record if not given.
+        """
+        from tabulate import tabulate
+
+        # today record may have changed since update_all, by bank or trader updates.
+        self.history_store.sync(self.db.history_data, revision=self.db.read_revision())
+        df = self.history_store.frame(start=start, end=end, limit=7 if to_email else None)
         df = df.reindex(columns=['Date', 'Portfolio_ILS', 'Profit_ILS', 'Profit_%', 'Foreign_Currencies',
                                  'Bank_CF', 'Trader_CF', 'Total_ILS', 'Total_USD'])
-        df.Date = df.Date.dt.strftime('%d-%m-%Y')
         df.Foreign_Currencies = df.Foreign_Currencies.round(2)
 
         if tabulate_output:
-            df.fillna('-', inplace=True)
-            if to_email:  # last week stats only.
-                def day_name(s):
-                    date_s = s.split('-')
-                    date_i = [int(d) for d in date_s]
-                    return date_i
-
-                df = df.iloc[:7]
+            if to_email:
                 df = df.drop(columns=['Total_USD'])
-                df.Date = df.Date.apply(lambda s: datetime.date(day=day_name(s)[0],
-                                                                month=day_name(s)[1],
-                                                                year=day_name(s)[2])
-                                        .strftime('%A'))
+                df.Date = df.Date.dt.day_name()
                 df = df.rename(columns={'Date': 'Day'})
-
+            else:
+                df.Date = df.Date.dt.strftime('%d-%m-%Y')
+            df = df.fillna('-')
             return tabulate(df, headers='keys', tablefmt='html', stralign='center',
                             numalign='center', floatfmt=",.2f", showindex=False)
 
         else:
-            df.index = df.Date
-            df.drop('Date', inplace=True)
-            return df
+            df.Date = df.Date.dt.strftime('%d-%m-%Y')
+            return df.set_index('Date')
 
-    def total_assets(self, in_usd: bool = False) -> float:
-        total_assets = self.db.stocks.sum_portfolio_field('Market_Value_ILS') \
-                       + self.db.history_data.get_latest_bank_cf() \
-                       + self.db.history_data.get_latest_trader_cf() \
-                       + self.db.foreign_currencies.sum_foreign_currency_field('Market_Value_ILS') \
+    def total_assets(self, in_usd: bool = False, fx: FxSnapshot = None, summary: dict = None) -> float:
+        """:param summary: dict, from MyMongoDB.portfolio_summary, fetched if not given."""
+        summary = summary or self.db.portfolio_summary()
+        total_assets = summary['Market_Value_ILS'] \
+                       + summary['Bank_CF'] \
+                       + summary['Trader_CF'] \
+                       + summary['Foreign_Currencies']
 
         if in_usd:
-            return self.currency_converter('ILS', 'USD', total_assets)
+            fx = fx or self.fx or self.refresh_fx()
+            return float(fx.convert('ILS', 'USD', total_assets))
         else:
             return total_assets
 
+    @mongo_db.revision_cached
     def df_assets(self, to_email: bool = False, plain_text: bool = False):
+        import pandas as pd
+        from tabulate import tabulate
 
-        profits = self.total_profit(numbers_only=True)
-        total_assets = self.total_assets()
-        foreign_currencies = self.db.foreign_currencies.sum_foreign_currency_field('Market_Value_ILS')
+        summary = self.db.portfolio_summary()
+        profits = self.total_profit(numbers_only=True, summary=summary)
+        total_assets = self.total_assets(summary=summary)
         data = [
-            f'{self.db.stocks.sum_portfolio_field("Market_Value_ILS"):,.2f}₪',
+            f'{summary["Market_Value_ILS"]:,.2f}₪',
             f'{profits[1]:,.2f} ₪',
             f'{profits[0]:,.2f} %',
-            f'{foreign_currencies:,.2f} ₪',
-            f'{self.db.history_data.get_latest_bank_cf():,.2f}₪',
-            f'{self.db.history_data.get_latest_trader_cf():,.2f}₪',
+            f'{summary["Foreign_Currencies"]:,.2f} ₪',
+            f'{summary["Bank_CF"]:,.2f}₪',
+            f'{summary["Trader_CF"]:,.2f}₪',
             f'{total_assets:,.2f}₪',
         ]
 
@@ -474,6 +531,9 @@ class MyFinanceManager:
 
     def graph(self, market_value: bool = False, profit_percentage: bool = False, profit_numbers: bool = False,
               save_only: bool = False):
+        import matplotlib.pyplot as plt
+        from matplotlib import cm as cm
+
         df = self.df_stocks()
         profits = self.total_profit()
         c_map = cm.get_cmap('viridis')
@@ -568,6 +628,7 @@ class MyFinanceManager:
                 return None
 
     def send_fancy_email(self, receiver_email: str):
+        import yagmail
 
         subject = 'MFM App Report'
 
@@ -1,43 +1,136 @@
 import atexit
+import functools
 import subprocess
+import threading
+from typing import NamedTuple
 
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne, DeleteOne, ASCENDING, DESCENDING, ReturnDocument
 
-from exceptions import logging, os, sys, datetime, TODAY
+from exceptions import lazy_class_attribute, logging, os, sys, datetime, TODAY
 
 LOG = logging.getLogger('MongoDB.Logger')
 handler = logging.StreamHandler(sys.stdout)
 LOG.addHandler(handler)
 
+TOTAL_FIELDS = ('Market_Value_ILS', 'Market_Value_USD', 'Profit_ILS', 'Profit_USD')
 
-class MyMongoDB:
-    _client = MongoClient()
-    db = _client['mfm']
-    user_name = os.getlogin()
+_writes = threading.local()  # depth of write methods running in thread
+_MISSING = object()  # revision_cached key with no cached result
+
+
+def bumps_revision(method):
+    """
+    Decorator for methods that write to database, every call changes database revision,
+    once for writes made by other write methods it calls.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_writes, 'depth', 0)
+        _writes.depth = depth + 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _writes.depth = depth
+            if not depth:
+                MyMongoDB.bump_revision()
+
+    return wrapper
+
+
+def revision_cached(method):
+    """
+    Decorator for reading methods, results are cached per arguments until the next database write
+    of any process (database revision change). Results with copy() are copied, so callers can change them.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:  # unhashable arguments, like dicts, are not cached
+            return method(self, *args, **kwargs)
+
+        revision = MyMongoDB.read_revision()
+        # a new revision gets a new cache dict, threads still holding the old one never see it cleared.
+        cache = self.__dict__.get('_revision_cache')
+        if cache is None or cache['revision'] != revision:
+            cache = self.__dict__['_revision_cache'] = {'revision': revision}
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = method(self, *args, **kwargs)
+            # a write while method ran, by another thread or process, may be missing from result.
+            if MyMongoDB.read_revision() != revision:
+                return result
+            cache[key] = result
+
+        return result.copy() if hasattr(result, 'copy') else result
+
+    return wrapper
+
+
+def _collection(name: str):
+    """collection class attribute, got from MyMongoDB.db on first access"""
+    return lazy_class_attribute(lambda: MyMongoDB.db[name])
 
-    def __init__(self):
+
+class MyMongoDB:
+    # client is created on first database access, not on import.
+    _client = lazy_class_attribute(MongoClient)
+    db = lazy_class_attribute(lambda: MyMongoDB._client['mfm'])
+    user_name = lazy_class_attribute(os.getlogin)
+    revision = 0  # database revision last read or written by this process
+
+    def __init__(self, derived_on_read: bool = None):
+        """
+        :param derived_on_read: bool, lots keep only purchase data and latest prices are kept in quotes collection,
+                                market values and profits are computed by every read.
+                                Saved in database, mode of database is used if not given.
+        """
         LOG.debug('initializing MongoDB object')
 
         self.stocks = _Stocks()
+        self.quotes = _Quotes()
         self.foreign_currencies = _ForeignCurrencies()
         self.user_info = _UserInfo()
         self.history_data = _HistoryData()
         self.last_modified = _LastModified()
+        self.totals = _PortfolioTotals()
+        self.lot_counters = _LotCounters()
+
+        self.ensure_indexes()
 
         if not self.user_info.collection.find_one({}):
             self.user_info.collection.insert_one({'user_name': self.user_name})
         else:
             self.user_name = self.user_info.collection.find_one({}, {'user_name': 1})['user_name']
 
+        # mode is kept in database, so the GUI, the schedule and the tools read lots of a database the same way.
+        # after a change, lots values or quotes written in the other mode are stale until the next prices update.
+        self.mode_changed = False
+        if derived_on_read is None:
+            derived_on_read = self.user_info.get_derived_on_read()
+        elif derived_on_read != self.user_info.get_derived_on_read():
+            self.user_info.set_derived_on_read(derived_on_read)
+            self.mode_changed = True
+        _Stocks.derived_on_read = derived_on_read
+        self.totals.ensure()
+
         # close connection on exit
         atexit.register(self.close_connection)
 
         LOG.info('MongoDB object created successfully')
 
+    @bumps_revision
     def _setup_test_collections(self):
         self.stocks.collection.aggregate([
             {'$merge': {'into': {'db': 'mfm_test', 'coll': 'stocks'}}}
         ])
+        self.quotes.collection.aggregate([
+            {'$merge': {'into': {'db': 'mfm_test', 'coll': 'quotes'}}}
+        ])
         self.foreign_currencies.collection.aggregate([
             {'$merge': {'into': {'db': 'mfm_test', 'coll': 'foreign_currencies'}}}
         ])
@@ -50,12 +143,34 @@ class MyMongoDB:
         self.last_modified.collection.aggregate([
             {'$merge': {'into': {'db': 'mfm_test', 'coll': 'last_modified'}}}
         ])
+        self.totals.collection.aggregate([
+            {'$merge': {'into': {'db': 'mfm_test', 'coll': 'portfolio_totals'}}}
+        ])
+        self.lot_counters.collection.aggregate([
+            {'$merge': {'into': {'db': 'mfm_test', 'coll': 'lot_counters'}}}
+        ])
         self.db = self._client['mfm_test']
         _Stocks.collection = self.db['stocks']
+        _Quotes.collection = self.db['quotes']
         _ForeignCurrencies.collection = self.db['foreign_currencies']
-        _UserInfo().collection = self.db['user_info']
-        _HistoryData().collection = self.db['history_data']
-        _LastModified().collection = self.db['last_modified']
+        _UserInfo.collection = self.db['user_info']
+        _HistoryData.collection = self.db['history_data']
+        _LastModified.collection = self.db['last_modified']
+        _PortfolioTotals.collection = self.db['portfolio_totals']
+        _LotCounters.collection = self.db['lot_counters']
+        self.ensure_indexes()
+        self.totals.ensure()
+
+    @classmethod
+    def read_revision(cls) -> int:
+        """:return: int, database revision, changed by every write, for revision_cached results."""
+        cls.revision = _PortfolioTotals().read_revision()
+        return cls.revision
+
+    @classmethod
+    def bump_revision(cls) -> int:
+        cls.revision = _PortfolioTotals().bump_revision()
+        return cls.revision
 
     @classmethod
     def _drop_db(cls, db_name: str):
@@ -68,8 +183,64 @@ class MyMongoDB:
         collections_count = len(self.db.list_collection_names())
         return True if collections_count == 4 else False
 
+    def _daos(self):
+        return [self.stocks, self.quotes, self.foreign_currencies, self.user_info, self.history_data, self.last_modified,
+                self.totals, self.lot_counters]
+
+    def ensure_indexes(self) -> list:
+        """
+        Create indexes declared by every collection class, indexes that already exist are skipped.
+        :return: list of created index names.
+        """
+        created = []
+        for dao in self._daos():
+            existing = [list(info['key']) for info in dao.collection.index_information().values()]
+            for keys in dao.indexes:
+                if keys not in existing:
+                    created.append(dao.collection.create_index(keys))
+                    LOG.info(f'Index {created[-1]} created on {dao.collection.name}')
+        return created
+
+    def audit_query_plans(self) -> list:
+        """
+        Explain every query of the collection classes and report collection scans and in-memory sorts.
+        :return: list of dicts, {'collection': str, 'query': str, 'problems': list of stage names}.
+        """
+        report = []
+        for dao in self._daos():
+            for query_name, command in dao.audit_commands().items():
+                explain = dao.collection.database.command('explain', command, verbosity='queryPlanner')
+                problems = _plan_problems(explain)
+                report.append({'collection': dao.collection.name, 'query': query_name, 'problems': problems})
+                if problems:
+                    LOG.warning(f'{dao.collection.name}.{query_name}: {", ".join(problems)}')
+        return report
+
+    @revision_cached
+    def portfolio_summary(self) -> dict:
+        """
+        All portfolio totals with one round trip, from portfolio totals document and latest cash flows.
+        :return: dict, Market_Value_ILS, Market_Value_USD, Profit_ILS, Profit_USD, Foreign_Currencies,
+                 Bank_CF and Trader_CF, 0 for totals with no data.
+        """
+        d = list(self.totals.collection.aggregate([
+            {'$match': {'_id': _PortfolioTotals.doc_id}},
+            {'$lookup': {'from': self.history_data.collection.name,
+                         'pipeline': _HistoryData._latest_cf_pipeline('bank_cf'), 'as': 'bank'}},
+            {'$lookup': {'from': self.history_data.collection.name,
+                         'pipeline': _HistoryData._latest_cf_pipeline('trader_cf'), 'as': 'trader'}},
+        ]))
+        d = d[0] if d else {**self.totals.recompute(), 'bank': [], 'trader': []}
+
+        return {
+            **{field: d.get(field, 0) for field in _PortfolioTotals.fields},
+            'Bank_CF': d['bank'][0]['bank_cf'] if d['bank'] else 0,
+            'Trader_CF': d['trader'][0]['trader_cf'] if d['trader'] else 0,
+        }
+
     def close_connection(self):
-        self._client.close()
+        if isinstance(MyMongoDB.__dict__['_client'], MongoClient):  # skip if client was never created
+            self._client.close()
         LOG.info('MongoDB connection closed')
         return True
 
@@ -80,55 +251,306 @@ class MyMongoDB:
         return True
 
 
+def _plan_problems(explain: dict) -> list:
+    """COLLSCAN and SORT stages of winning plans, and $sort stages left in aggregation pipeline"""
+    problems = set()
+
+    def walk(node, in_winning_plan: bool):
+        if isinstance(node, dict):
+            if in_winning_plan and node.get('stage') in ('COLLSCAN', 'SORT'):
+                problems.add(node['stage'])
+            for key, value in node.items():
+                if key in ('command', 'rejectedPlans'):  # echo of the command, and plans not used
+                    continue
+                if key == '$sort':
+                    problems.add('SORT')
+                walk(value, in_winning_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, in_winning_plan)
+
+    walk(explain, False)
+    return sorted(problems)
+
+
+def _sum_pipeline(field_name: str) -> list:
+    return [
+        {'$group': {'_id': None, 'total': {'$sum': f'${field_name}'}}},
+        {'$project': {'_id': 0}}
+    ]
+
+
+class Lot(NamedTuple):
+    """Purchase data of one stock lot, as loaded by _Stocks.load_lots."""
+    symbol: str
+    lot_num: int
+    currency: str
+    amount: float
+    buy_price: float
+    tase_index: int or str = None
+    lot_id: ObjectId = None  # _id of lot document, lot numbers of legacy databases may repeat
+
+
 class _Stocks:
-    collection = MyMongoDB.db['stocks']
+    collection = _collection('stocks')
+    indexes = [[('symbol', ASCENDING), ('Lot_Num', ASCENDING)]]
+    derived_on_read = False  # set by MyMongoDB
+    purchase_fields = ('symbol', 'Lot_Num', 'Date', 'Amount', 'Buy_Price', 'Currency', 'TASE_INDEX')
+    lot_projection = {'symbol': 1, 'Lot_Num': 1, 'Currency': 1, 'Amount': 1, 'Buy_Price': 1,
+                      'TASE_INDEX': 1}
+    df_pipeline = [
+        {'$project': {'_id': 0, 'Symbol': '$symbol', 'Market_Value_ILS': 1, 'Lot': '$Lot_Num', 'Date': 1,
+                      'Amount': 1, 'Buy_Price': 1, 'Currency': 1, 'Profit_%': 1, 'Profit_ILS': 1}},
+        {'$sort': {'Market_Value_ILS': -1}}
+    ]
+
+    @classmethod
+    def valued_pipeline(cls) -> list:
+        """
+        Stages that set market values and profits of lots from quotes collection, in derived_on_read mode.
+        Same values as revaluation.revalue, TASE prices are in agorot.
+        """
+        if not cls.derived_on_read:
+            return []
+
+        scale = {'$cond': [{'$eq': ['$Currency', 'ILS']}, 0.01, 1]}
+        is_ils = {'$eq': ['$Currency', 'ILS']}
+        return [
+            {'$lookup': {'from': _Quotes.collection.name, 'localField': 'symbol', 'foreignField': 'symbol',
+                         'as': 'quote'}},
+            {'$unwind': {'path': '$quote', 'preserveNullAndEmptyArrays': True}},
+            {'$addFields': {
+                'current': {'$multiply': ['$quote.Price', '$Amount', scale]},
+                'start': {'$multiply': ['$Buy_Price', '$Amount', scale]},
+            }},
+            {'$addFields': {
+                'profit': {'$round': [{'$subtract': ['$current', '$start']}, 3]},
+                'converted': {'$round': [{'$cond': [is_ils, {'$divide': ['$current', '$quote.USD_ILS']},
+                                                    {'$multiply': ['$current', '$quote.USD_ILS']}]}, 3]},
+            }},
+            {'$addFields': {
+                'converted_profit': {'$round': [{'$cond': [is_ils, {'$divide': ['$profit', '$quote.USD_ILS']},
+                                                           {'$multiply': ['$profit', '$quote.USD_ILS']}]}, 3]},
+            }},
+            {'$addFields': {
+                'Market_Value_USD': {'$cond': [is_ils, '$converted', '$current']},
+                'Market_Value_ILS': {'$cond': [is_ils, '$current', '$converted']},
+                'Profit_%': {'$cond': [{'$eq': ['$start', 0]}, None, {'$round': [{'$subtract': [
+                    {'$multiply': [{'$divide': ['$current', '$start']}, 100]}, 100]}, 3]}]},
+                'Profit_ILS': {'$cond': [is_ils, '$profit', '$converted_profit']},
+                'Profit_USD': {'$cond': [is_ils, '$converted_profit', '$profit']},
+            }},
+            {'$project': {'quote': 0, 'current': 0, 'start': 0, 'profit': 0, 'converted': 0, 'converted_profit': 0}},
+        ]
+
+    def audit_commands(self) -> dict:
+        name = self.collection.name
+        lot_filter = {'symbol': '', 'Lot_Num': 1}
+        return {
+            'fetch_data_for_df': {'aggregate': name, 'pipeline': self.valued_pipeline() + self.df_pipeline,
+                                  'cursor': {}},
+            'sum_portfolio_field': {'aggregate': name,
+                                    'pipeline': self.valued_pipeline() + _sum_pipeline('Market_Value_ILS'),
+                                    'cursor': {}},
+            'get_stocks_names': {'distinct': name, 'key': 'symbol', 'query': {}},
+            'load_lots': {'find': name, 'filter': {'symbol': {'$in': ['']}}, 'projection': self.lot_projection,
+                          'sort': {'symbol': 1, 'Lot_Num': 1}},
+            'bulk_write_lots': {'find': name, 'filter': lot_filter},
+            'get_field_from_stock': {'find': name, 'filter': lot_filter, 'limit': 1},
+            'get_stock_lots_count': {'aggregate': name, 'cursor': {}, 'pipeline': [
+                {'$match': {'symbol': ''}}, {'$group': {'_id': '$symbol', 'count': {'$sum': 1}}}]},
+        }
 
     def fetch_data_for_df(self):
-        data = list(self.collection.aggregate([
-            {'$project': {'_id': 0, 'Symbol': '$symbol', 'Market_Value_ILS': 1, 'Lot': '$Lot_Num', 'Date': 1,
-                          'Amount': 1, 'Buy_Price': 1, 'Currency': 1, 'Profit_%': 1, 'Profit_ILS': 1}},
-            {'$sort': {'Market_Value_ILS': -1}}
-        ]))
+        data = list(self.collection.aggregate(self.valued_pipeline() + self.df_pipeline))
         return data
 
     def sum_portfolio_field(self, field_name):
-        field_sum = list(self.collection.aggregate([
-            {'$group': {'_id': None, 'total': {'$sum': f'${field_name}'}}},
-            {'$project': {'_id': 0}}
-        ]
-        ))[0]
+        field_sum = list(self.collection.aggregate(self.valued_pipeline() + _sum_pipeline(field_name)))[0]
         return field_sum['total']
 
-    def get_stocks_names(self):
+    def get_currency_indexes(self) -> list:
+        """:return: list of str, TASE_INDEX of currency lots, like 'USD', they are priced from FX rates."""
+        return self.collection.distinct('TASE_INDEX', {'TASE_INDEX': {'$type': 'string'}})
+
+    def get_stocks_names(self, currency: str = None):
+        if currency:
+            return self.collection.distinct('symbol', {'Currency': currency})
         return self.collection.distinct('symbol')
 
+    @bumps_revision
     def insert_lot_to_stock(self, symbol: str, d: dict):
         self.collection.update_one({'symbol': symbol}, {'$set': d})
         return True
 
+    @staticmethod
+    def lot_update(lot_id: ObjectId, fields: dict):
+        """bulk operation for setting fields of lot"""
+        return UpdateOne({'_id': lot_id}, {'$set': fields})
+
+    @staticmethod
+    def lot_amount_update(symbol: str, lot_num: int, sell_amount: int):
+        """bulk operation for removing sell_amount shares from lot"""
+        return UpdateOne({'symbol': symbol, 'Lot_Num': lot_num}, {'$inc': {'Amount': -sell_amount}})
+
+    @staticmethod
+    def lot_sale(lot: dict, sold: float):
+        """
+        bulk operation for removing sold shares from lot of _lots_values, by its _id,
+        values are set to the shares left, as values are proportional to amount.
+        """
+        left = (lot['Amount'] - sold) / lot['Amount']
+        return UpdateOne({'_id': lot['_id']}, {'$inc': {'Amount': -sold},
+                                               '$set': {field: lot[field] * left for field in TOTAL_FIELDS
+                                                        if field in lot}})
+
+    @staticmethod
+    def lot_removal(symbol: str, lot_num: int = None):
+        """bulk operation for removing lot, or first lot of symbol if lot_num not given"""
+        if lot_num:
+            return DeleteOne({'symbol': symbol, 'Lot_Num': lot_num})
+        return DeleteOne({'symbol': symbol})
+
+    @bumps_revision
+    def bulk_write_lots(self, requests, totals_delta: dict = None, ordered: bool = False) -> dict:
+        """
+        Send many lot operations with one bulk write, unordered unless requests depend on each other.
+        :param requests: iterable of operations from lot_update, lot_amount_update, lot_sale and lot_removal.
+        :param totals_delta: dict, {total field: change} made by requests, added to portfolio totals.
+        :param ordered: bool, run requests in order, like renumbering lots after removing lots before them.
+        :return: dict, {'matched': int, 'modified': int, 'deleted': int}
+        """
+        requests = list(requests)
+        if not requests:
+            return {'matched': 0, 'modified': 0, 'deleted': 0}
+
+        result = self.collection.bulk_write(requests, ordered=ordered)
+        counts = {'matched': result.matched_count, 'modified': result.modified_count,
+                  'deleted': result.deleted_count}
+        LOG.debug(f'Stocks bulk write of {len(requests)} operations: {counts}')
+        if totals_delta is not None:
+            self._update_totals(totals_delta)
+        return counts
+
+    def _update_totals(self, delta: dict):
+        """add change of lots values to portfolio totals, lots values are only known on read in derived_on_read mode"""
+        if self.derived_on_read:
+            _PortfolioTotals().recompute()
+        else:
+            _PortfolioTotals().inc(delta)
+
+    def _lots_values(self, query: dict) -> list:
+        """:return: list of lots with _id, symbol, Lot_Num, Amount and TOTAL_FIELDS, sorted by Lot_Num and _id."""
+        return list(self.collection.find(query, {'symbol': 1, 'Lot_Num': 1, 'Amount': 1,
+                                                 **{field: 1 for field in TOTAL_FIELDS}})
+                    .sort([('Lot_Num', ASCENDING), ('_id', ASCENDING)]))
+
     def update_stock_amount(self, symbol: str, lot_num: int, sell_amount: int):
-        self.collection.update_one({'symbol': symbol, 'Lot_Num': lot_num}, {'$inc': {'Amount': -sell_amount}})
+        lot = self._lots_values({'symbol': symbol, 'Lot_Num': lot_num})[0]
+        sold = sell_amount / lot['Amount']  # values are proportional to amount
+        self.bulk_write_lots([self.lot_sale(lot, sell_amount)],
+                             totals_delta={field: -lot.get(field, 0) * sold for field in TOTAL_FIELDS})
         return True
 
+    def sell_lots(self, symbol: str, sell_amount: float) -> int:
+        """
+        Remove sell_amount shares of symbol by FIFO, first lot to come in - first to come out.
+        Sold lots are planned from one snapshot of symbol lots and written with one ordered bulk write,
+        lots left are renumbered from 1, so next lot number is always lots count + 1.
+        Operations target lots by _id, as databases of old versions may have lots with the same number.
+        :return: int, lots left of symbol.
+        :raise: ValueError if symbol has less than sell_amount shares.
+        """
+        lots = self._lots_values({'symbol': symbol})
+        owned = sum(lot['Amount'] for lot in lots)
+        if sell_amount <= 0 or sell_amount > owned:
+            raise ValueError(f'Can not sell {sell_amount} shares of {symbol}, portfolio has {owned}')
+
+        requests, kept = [], []
+        delta = dict.fromkeys(TOTAL_FIELDS, 0.0)
+        for lot in lots:
+            sold = min(lot['Amount'], sell_amount)
+            sell_amount -= sold
+            if sold == lot['Amount']:
+                requests.append(DeleteOne({'_id': lot['_id']}))
+            else:
+                if sold:
+                    requests.append(self.lot_sale(lot, sold))
+                kept.append(lot)
+            for field in TOTAL_FIELDS:  # values are proportional to amount
+                delta[field] -= lot.get(field, 0) * sold / lot['Amount']
+
+        requests.extend(UpdateOne({'_id': lot['_id']}, {'$set': {'Lot_Num': new_num}})
+                        for new_num, lot in enumerate(kept, start=1) if new_num != lot['Lot_Num'])
+        self.bulk_write_lots(requests, totals_delta=delta, ordered=True)
+        _LotCounters().reset(symbol, len(kept))
+        return len(kept)
+
     def update_stock_lot(self, symbol: str, lot_num: int, market_val_ils: float, market_val_usd: float,
                          profit_usd: float, profit_ils: float, profit_percentage: float):
-        self.collection.update_one({'symbol': symbol, 'Lot_Num': lot_num}, {'$set': {
+        self.update_stock_lots([{
+            '_id': self.collection.find_one({'symbol': symbol, 'Lot_Num': lot_num}, {'_id': 1})['_id'],
             'Market_Value_USD': market_val_usd,
             'Market_Value_ILS': market_val_ils,
             'Profit_%': profit_percentage,
             'Profit_ILS': profit_ils,
             'Profit_USD': profit_usd,
-        }})
+        }])
         return True
 
+    def update_stock_lots(self, lots) -> dict:
+        """
+        Set revalued fields of many lots with one bulk write, portfolio totals change by new minus old values.
+        :param lots: iterable of dicts with _id of lot and the fields to set, symbol and Lot_Num are not set.
+        :return: dict, counts from bulk_write_lots.
+        """
+        lots = [{key: value for key, value in d.items() if key not in ('symbol', 'Lot_Num')} for d in lots]
+        old = {d['_id']: d for d in self._lots_values({'_id': {'$in': [d['_id'] for d in lots]}})}
+
+        delta = dict.fromkeys(TOTAL_FIELDS, 0.0)
+        for d in lots:
+            old_values = old.get(d['_id'], {})
+            for field in TOTAL_FIELDS:
+                delta[field] += d.get(field, old_values.get(field, 0)) - old_values.get(field, 0)
+
+        return self.bulk_write_lots((self.lot_update(d.pop('_id'), d) for d in lots), totals_delta=delta)
+
+    def load_lots(self, symbols: list = None) -> list:
+        """
+        All lots, or all lots of symbols, with one projected query ordered by symbol and lot number.
+        :param symbols: list of str, like ['VTI', 'IJR'], all symbols if not given.
+        :return: list of Lot.
+        """
+        query = {'symbol': {'$in': list(symbols)}} if symbols else {}
+        cursor = self.collection.find(query, self.lot_projection)
+        cursor.sort([('symbol', ASCENDING), ('Lot_Num', ASCENDING), ('_id', ASCENDING)])
+        return [Lot(d['symbol'], d['Lot_Num'], d['Currency'], d['Amount'], d['Buy_Price'], d.get('TASE_INDEX'),
+                    d['_id'])
+                for d in cursor]
+
     def get_field_from_stock(self, symbol: str, lot_num: int, field: str):
         return self.collection.find_one({'symbol': symbol, 'Lot_Num': lot_num},
                                         {field: 1})[field]
 
+    @bumps_revision
     def insert_stock(self, d):
         self.collection.insert_one(d)
+        self._update_totals({field: d.get(field, 0) for field in TOTAL_FIELDS})
         return True
 
+    @bumps_revision
+    def insert_stocks(self, docs: list) -> int:
+        """
+        Insert many lots with one insert_many, and add their values to portfolio totals once.
+        :return: int, inserted lots count.
+        """
+        if not docs:
+            return 0
+        result = self.collection.insert_many(docs)
+        self._update_totals({field: sum(d.get(field, 0) for d in docs) for field in TOTAL_FIELDS})
+        LOG.debug(f'{len(result.inserted_ids)} lots inserted')
+        return len(result.inserted_ids)
+
     def get_stock_lots_count(self, symbol: str = None, per_stock: bool = False):
         if per_stock:
             lots_count = list(self.collection.aggregate([
@@ -147,64 +569,124 @@ class _Stocks:
             return lots_count[0]['count']
 
     def remove_stock(self, symbol: str, lot_num: int = None):
-        if lot_num:
-            self.collection.delete_one({'symbol': symbol, 'Lot_Num': lot_num})
-        else:
-            self.collection.delete_one({'symbol': symbol})
+        lots = self._lots_values({'symbol': symbol, 'Lot_Num': lot_num} if lot_num else {'symbol': symbol})[:1]
+        self.bulk_write_lots([self.lot_removal(symbol, lot_num)],
+                             totals_delta={field: -sum(lot.get(field, 0) for lot in lots) for field in TOTAL_FIELDS})
         return True
 
 
+class _Quotes:
+    """Latest price of every symbol, for derived_on_read mode, TASE prices are in agorot."""
+    collection = _collection('quotes')
+    indexes = [[('symbol', ASCENDING)]]
+
+    def audit_commands(self) -> dict:
+        return {'update_quotes': {'find': self.collection.name, 'filter': {'symbol': ''}}}
+
+    @bumps_revision
+    def update_quotes(self, quotes: dict, usd_ils: float) -> dict:
+        """
+        One write per symbol with one unordered bulk write, lots of symbol are revalued by the next read.
+        :param quotes: dict, {symbol: {'Price': float, 'Currency': str}}.
+        :param usd_ils: float, USD to ILS rate of the prices snapshot.
+        :return: dict, {'matched': int, 'upserted': int}
+        """
+        if not quotes:
+            return {'matched': 0, 'upserted': 0}
+
+        now = datetime.datetime.now()
+        result = self.collection.bulk_write([
+            UpdateOne({'symbol': symbol}, {'$set': {**quote, 'USD_ILS': usd_ils, 'date': now}}, upsert=True)
+            for symbol, quote in quotes.items()
+        ], ordered=False)
+        counts = {'matched': result.matched_count, 'upserted': result.upserted_count}
+        LOG.debug(f'Quotes bulk write of {len(quotes)} symbols: {counts}')
+        _PortfolioTotals().recompute()
+        return counts
+
+    def get_quote(self, symbol: str) -> dict:
+        return self.collection.find_one({'symbol': symbol}, {'_id': 0})
+
+
 class _ForeignCurrencies:
-    collection = MyMongoDB.db['foreign_currencies']
+    collection = _collection('foreign_currencies')
+    indexes = [[('symbol', ASCENDING), ('Lot_Type', ASCENDING)]]
+    df_pipeline = [
+        {'$project': {'_id': 0, 'Symbol': '$symbol', 'Market_Value_ILS': 1, 'Lot': '$Lot_Type', 'Currency': 'ILS'}},
+        {'$sort': {'Market_Value_ILS': -1}}
+    ]
+
+    def audit_commands(self) -> dict:
+        name = self.collection.name
+        return {
+            'fetch_data_for_df': {'aggregate': name, 'pipeline': self.df_pipeline, 'cursor': {}},
+            'sum_foreign_currency_field': {'aggregate': name, 'pipeline': _sum_pipeline('Market_Value_ILS'),
+                                           'cursor': {}},
+            'update_foreign_currency': {'find': name, 'filter': {'symbol': '', 'Lot_Type': ''}},
+        }
 
     def fetch_data_for_df(self):
-        data = list(self.collection.aggregate([
-            {'$project': {'_id': 0, 'Symbol': '$symbol', 'Market_Value_ILS': 1, 'Lot': '$Lot_Type', 'Currency': 'ILS'}},
-            {'$sort': {'Market_Value_ILS': -1}}
-        ]))
+        data = list(self.collection.aggregate(self.df_pipeline))
         return data
 
     def get_foreign_currencies_names(self):
         return self.collection.distinct('symbol')
 
     def sum_foreign_currency_field(self, field_name):
-        field_sum = list(self.collection.aggregate([
-            {'$group': {'_id': None, 'total': {'$sum': f'${field_name}'}}},
-            {'$project': {'_id': 0}}
-        ]
-        ))[0]
+        field_sum = list(self.collection.aggregate(_sum_pipeline(field_name)))[0]
         return field_sum['total']
 
+    @bumps_revision
     def insert_lot_to_stock(self, symbol: str, d: dict):
         self.collection.update_one({'symbol': symbol}, {'$set': d})
         return True
 
+    @bumps_revision
     def insert_stock(self, d):
         self.collection.insert_one(d)
+        _PortfolioTotals().inc({'Foreign_Currencies': d.get('Market_Value_ILS', 0)})
         return True
 
+    @bumps_revision
     def remove_stock(self, symbol: str, lot_type: str = None):
-        if lot_type:
-            self.collection.delete_one({'symbol': symbol, 'Lot_Type': lot_type})
-        else:
-            self.collection.delete_one({'symbol': symbol})
+        query = {'symbol': symbol, 'Lot_Type': lot_type} if lot_type else {'symbol': symbol}
+        removed = self.collection.find_one_and_delete(query, {'Market_Value_ILS': 1}) or {}
+        _PortfolioTotals().inc({'Foreign_Currencies': -removed.get('Market_Value_ILS', 0)})
         return True
 
+    @bumps_revision
     def update_foreign_currency(self, symbol: str, lot_type: str, market_val_ils: float, market_val_usd: float):
-        self.collection.update_one({'symbol': symbol, 'Lot_Type': lot_type}, {'$set': {
+        old = self.collection.find_one_and_update({'symbol': symbol, 'Lot_Type': lot_type}, {'$set': {
             'Market_Value_USD': market_val_usd,
             'Market_Value_ILS': market_val_ils,
         }},
-                                   upsert=True)
+                                                  {'Market_Value_ILS': 1}, upsert=True,
+                                                  return_document=ReturnDocument.BEFORE) or {}
+        _PortfolioTotals().inc({'Foreign_Currencies': market_val_ils - old.get('Market_Value_ILS', 0)})
         return True
 
 
 class _UserInfo:
-    collection = MyMongoDB.db['user_info']
+    collection = _collection('user_info')
+    indexes = [[('user_name', ASCENDING)]]
+
+    def audit_commands(self) -> dict:
+        return {'get_user_email_address': {'find': self.collection.name, 'filter': {'user_name': ''}, 'limit': 1}}
 
     def get_user_email_address(self):
         return self.collection.find_one({'user_name': MyMongoDB.user_name}, {'email_address': 1})['email_address']
 
+    def get_derived_on_read(self) -> bool:
+        d = self.collection.find_one({'user_name': MyMongoDB.user_name}, {'derived_on_read': 1}) or {}
+        return d.get('derived_on_read', False)
+
+    @bumps_revision
+    def set_derived_on_read(self, derived_on_read: bool):
+        self.collection.update_one({'user_name': MyMongoDB.user_name},
+                                   {'$set': {'derived_on_read': derived_on_read}})
+        return True
+
+    @bumps_revision
     def change_email_address(self, new_email_address: str):
         self.collection.update_one({'user_name': MyMongoDB.user_name},
                                    {'$set': {'email_address': new_email_address}})
@@ -212,93 +694,124 @@ class _UserInfo:
 
 
 class _HistoryData:
-    collection = MyMongoDB.db['history_data']
+    collection = _collection('history_data')
+    indexes = [[('date', DESCENDING)]]
+    df_pipeline = [
+        {'$sort': {'date': -1}},
+        {'$project': {'_id': 0, 'Portfolio_ILS': '$market_value.portfolio.ILS',
+                      'Portfolio_USD': '$market_value.portfolio.USD',
+                      'Total_ILS': '$market_value.total_assets.ILS',
+                      'Total_USD': '$market_value.total_assets.USD',
+                      'Profit_%': '$profit.percentage',
+                      'Profit_ILS': '$profit.ILS',
+                      'Bank_CF': '$bank_cf', 'Trader_CF': '$trader_cf', 'Date': '$date',
+                      'Foreign_Currencies': '$foreign_currencies'
+                      }},
+    ]
 
-    def get_latest_trader_cf(self):
-        cf = list(self.collection.aggregate([
-            {'$match': {'trader_cf': {'$exists': True}}},
-            {'$project': {'_id': 0, 'trader_cf': 1, 'date': 1}},
+    @staticmethod
+    def _latest_cf_pipeline(*field_names: str) -> list:
+        """latest record that has all field_names"""
+        return [
+            {'$match': {field_name: {'$exists': True} for field_name in field_names}},
             {'$sort': {'date': -1}},
             {'$limit': 1},
-        ]))[0]['trader_cf']
+            {'$project': {'_id': 0, 'date': 1, **{field_name: 1 for field_name in field_names}}},
+        ]
+
+    def audit_commands(self) -> dict:
+        name = self.collection.name
+        return {
+            'get_latest_trader_cf': {'aggregate': name, 'pipeline': self._latest_cf_pipeline('trader_cf'),
+                                     'cursor': {}},
+            'get_latest_bank_cf': {'aggregate': name, 'pipeline': self._latest_cf_pipeline('bank_cf'), 'cursor': {}},
+            'fetch_data_for_df': {'aggregate': name, 'pipeline': self.df_pipeline, 'cursor': {}},
+            'fetch_data_for_df_week': {'aggregate': name, 'pipeline': self._df_pipeline(limit=7), 'cursor': {}},
+            'count': {'count': name, 'query': {}},
+            'update_all': {'aggregate': name, 'pipeline': self._latest_cf_pipeline('bank_cf', 'trader_cf'),
+                           'cursor': {}},
+            'update_bank': {'find': name, 'filter': {'date': datetime.datetime.strptime(TODAY, '%d-%m-%Y')}},
+        }
+
+    @revision_cached
+    def get_latest_trader_cf(self):
+        cf = list(self.collection.aggregate(self._latest_cf_pipeline('trader_cf')))[0]['trader_cf']
         return cf
 
+    @revision_cached
     def get_latest_bank_cf(self):
-        cf = list(self.collection.aggregate([
-            {'$match': {'bank_cf': {'$exists': True}}},
-            {'$project': {'_id': 0, 'bank_cf': 1, 'date': 1}},
-            {'$sort': {'date': -1}},
-            {'$limit': 1},
-        ]))[0]['bank_cf']
+        cf = list(self.collection.aggregate(self._latest_cf_pipeline('bank_cf')))[0]['bank_cf']
         return cf
 
-    def fetch_data_for_df(self):
-        data = list(self.collection.aggregate([
-            {'$project': {'_id': 0, 'Portfolio_ILS': '$market_value.portfolio.ILS',
-                          'Portfolio_USD': '$market_value.portfolio.USD',
-                          'Total_ILS': '$market_value.total_assets.ILS',
-                          'Total_USD': '$market_value.total_assets.USD',
-                          'Profit_%': '$profit.percentage',
-                          'Profit_ILS': '$profit.ILS',
-                          'Bank_CF': '$bank_cf', 'Trader_CF': '$trader_cf', 'Date': '$date',
-                          'Foreign_Currencies': '$foreign_currencies'
-                          }},
-            {'$sort': {'Date': -1}}
+    def _df_pipeline(self, start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None):
+        """df_pipeline of records between start and end, matched and limited on server"""
+        dates = {}
+        if start is not None:
+            dates['$gte'] = start
+        if end is not None:
+            dates['$lte'] = end
+        pipeline = [{'$match': {'date': dates}}] if dates else []
+        pipeline.append(self.df_pipeline[0])  # latest first, so limit keeps latest records
+        if limit:
+            pipeline.append({'$limit': limit})
+        return pipeline + self.df_pipeline[1:]
+
+    def count(self) -> int:
+        return self.collection.count_documents({})
+
+    def fingerprint(self, columns) -> dict:
+        """
+        :param columns: iterable of df_pipeline fields, like history_store.HISTORY_COLUMNS.
+        :return: dict, count of records and sum of every column, missing values count as 0.
+        """
+        d = list(self.collection.aggregate(self.df_pipeline[1:] + [
+            {'$group': {'_id': None, 'count': {'$sum': 1}, **{column: {'$sum': f'${column}'} for column in columns}}}
         ]))
+        return d[0] if d else {'count': 0, **{column: 0 for column in columns}}
+
+    def fetch_data_for_df(self, start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None):
+        """
+        :param start: datetime, first day of records, from first record if not given.
+        :param end: datetime, last day of records, included, to last record if not given.
+        :param limit: int, count of latest records in window, all of them if not given.
+        :return: list of records, latest first.
+        """
+        data = list(self.collection.aggregate(self._df_pipeline(start, end, limit)))
         return data
 
+    @bumps_revision
     def update_trader(self, cf: float):
         self.collection.update_one({'date': datetime.datetime.strptime(TODAY, '%d-%m-%Y')},
                                    {'$set': {'trader_cf': cf}}, upsert=True)
         return True
 
+    @bumps_revision
     def update_bank(self, cf: float):
         self.collection.update_one({'date': datetime.datetime.strptime(TODAY, '%d-%m-%Y')},
                                    {'$set': {'bank_cf': cf}}, upsert=True)
         return True
 
+    @bumps_revision
     def update_all(self, total_assets_ils: float, total_assets_usd: float, total_profit: tuple):
-        d = list(self.collection.aggregate([
-            {'$match': {'bank_cf': {'$exists': True}, 'trader_cf': {'$exists': True}}},
-            {'$project': {'trader_cf': 1, 'bank_cf': 1, 'date': 1}},
-            {'$sort': {'date': -1}},
-            {'$limit': 1},
-            {'$lookup': {
-                'from': 'foreign_currencies',
-                'pipeline': [{'$group': {'_id': None, 'sum': {'$sum': '$Market_Value_ILS'}}}],
-                'as': 'Foreign_Currencies'
-            }},
-            {'$lookup': {
-                'from': 'stocks',
-                'pipeline': [{'$group': {'_id': None, 'sum': {'$sum': '$Profit_ILS'}}}],
-                'as': 'Profit_ILS'
-            }},
-            {'$lookup': {
-                'from': 'stocks',
-                'pipeline': [{'$group': {'_id': None, 'sum': {'$sum': '$Market_Value_USD'}}}],
-                'as': 'Market_Value_USD'
-            }},
+        d = list(self.collection.aggregate(self._latest_cf_pipeline('bank_cf', 'trader_cf') + [
             {'$lookup': {
-                'from': 'stocks',
-                'pipeline': [{'$group': {'_id': None, 'sum': {'$sum': '$Market_Value_ILS'}}}],
-                'as': 'Market_Value_ILS'
+                'from': _PortfolioTotals.collection.name,
+                'pipeline': [{'$match': {'_id': _PortfolioTotals.doc_id}}],
+                'as': 'totals'
             }},
-            {'$project': {'_id': 0, 'Foreign_Currencies': '$Foreign_Currencies.sum',
-                          'Total_Profit_ILS': '$Profit_ILS.sum',
-                          'Total_Market_Value_ILS': '$Market_Value_ILS.sum',
-                          'Total_Market_Value_USD': '$Market_Value_USD.sum', 'trader_cf': 1, 'bank_cf': 1}},
         ]))[0]
+        totals = d['totals'][0] if d['totals'] else _PortfolioTotals().recompute()
 
         portfolio_market_value = {
-            'ILS': d["Total_Market_Value_ILS"][0],
-            'USD': d["Total_Market_Value_USD"][0]
+            'ILS': totals['Market_Value_ILS'],
+            'USD': totals['Market_Value_USD']
         }
         total_assets = {
             'ILS': total_assets_ils,
             'USD': total_assets_usd
         }
         profit = {
-            'ILS': d["Total_Profit_ILS"][0],
+            'ILS': totals['Profit_ILS'],
             'percentage': total_profit[0]
         }
 
@@ -307,14 +820,22 @@ class _HistoryData:
                                              'market_value': {'portfolio': portfolio_market_value,
                                                               'total_assets': total_assets},
                                              'profit': profit,
-                                             'foreign_currencies': d['Foreign_Currencies'][0]
+                                             'foreign_currencies': totals['Foreign_Currencies']
                                              }},
                                    upsert=True)
         return True
 
 
 class _LastModified:
-    collection = MyMongoDB.db['last_modified']
+    collection = _collection('last_modified')
+    indexes = [[('type', ASCENDING)]]
+
+    def audit_commands(self) -> dict:
+        name = self.collection.name
+        return {
+            'get_all': {'find': name, 'filter': {}, 'projection': {'last_modified': 1, '_id': 0}},
+            'get_field': {'find': name, 'filter': {'type': ''}, 'limit': 1},
+        }
 
     def get_all(self):
         data = self.collection.find({}, {'last_modified': 1, '_id': 0})
@@ -323,6 +844,122 @@ class _LastModified:
     def get_field(self, field_name: str):
         return self.collection.find_one({'type': field_name}, {'last_modified': 1})['last_modified']
 
+    @bumps_revision
     def update_field(self, field_name: str):
         self.collection.update_one({'type': field_name}, {'$set': {'last_modified': datetime.datetime.now()}})
         return True
+
+
+class _PortfolioTotals:
+    """
+    One document with portfolio totals, every write of lots and foreign currencies adds its change with $inc,
+    so reading totals is one document read instead of summing all lots.
+    The document also keeps database revision, changed by every write of MFM processes.
+    """
+    collection = _collection('portfolio_totals')
+    indexes = []  # read by _id
+    fields = TOTAL_FIELDS + ('Foreign_Currencies',)
+    doc_id = 'totals'
+
+    def audit_commands(self) -> dict:
+        return {'get': {'find': self.collection.name, 'filter': {'_id': self.doc_id}, 'limit': 1}}
+
+    def get(self) -> dict:
+        """:return: dict, {field: total}, recomputed if totals document is missing."""
+        return self.collection.find_one({'_id': self.doc_id}, {'_id': 0, 'revision': 0}) or self.recompute()
+
+    def ensure(self):
+        """compute totals of database that has no totals yet"""
+        if not self.collection.find_one({'_id': self.doc_id, self.fields[0]: {'$exists': True}}, {'_id': 1}):
+            self.recompute()
+
+    def read_revision(self) -> int:
+        d = self.collection.find_one({'_id': self.doc_id}, {'_id': 0, 'revision': 1}) or {}
+        return d.get('revision', 0)
+
+    def bump_revision(self) -> int:
+        d = self.collection.find_one_and_update({'_id': self.doc_id}, {'$inc': {'revision': 1}},
+                                                {'_id': 0, 'revision': 1}, upsert=True,
+                                                return_document=ReturnDocument.AFTER)
+        return d['revision']
+
+    @bumps_revision
+    def inc(self, delta: dict):
+        delta = {field: float(change) for field, change in delta.items() if change}
+        if delta:
+            self.collection.update_one({'_id': self.doc_id}, {'$inc': delta}, upsert=True)
+
+    @bumps_revision
+    def recompute(self) -> dict:
+        """
+        Sum all lots and foreign currencies and replace totals document.
+        :return: dict, {field: total}.
+        """
+        d = list(_Stocks.collection.aggregate([
+            {'$facet': {'stocks': _Stocks.valued_pipeline() + [
+                {'$group': {'_id': None, **{field: {'$sum': f'${field}'} for field in TOTAL_FIELDS}}}]}},
+            {'$lookup': {'from': _ForeignCurrencies.collection.name,
+                         'pipeline': _sum_pipeline('Market_Value_ILS'), 'as': 'foreign_currencies'}},
+        ]))[0]
+
+        stocks = d['stocks'][0] if d['stocks'] else {}
+        totals = {field: stocks.get(field, 0) for field in TOTAL_FIELDS}
+        totals['Foreign_Currencies'] = d['foreign_currencies'][0]['total'] if d['foreign_currencies'] else 0
+        self.collection.update_one({'_id': self.doc_id}, {'$set': totals}, upsert=True)  # keeps revision
+        return totals
+
+    def check_drift(self, tolerance: float = 0.01) -> dict:
+        """
+        Compare totals document to a full recompute, and keep the recomputed totals.
+        :param tolerance: float, differences up to tolerance are float rounding, not drift.
+        :return: dict, {field: recomputed - stored} of drifted fields.
+        """
+        stored = self.collection.find_one({'_id': self.doc_id}, {'_id': 0}) or {}
+        recomputed = self.recompute()
+        drift = {field: recomputed[field] - stored.get(field, 0) for field in self.fields
+                 if abs(recomputed[field] - stored.get(field, 0)) > tolerance}
+        if drift:
+            LOG.warning(f'Portfolio totals drifted from lots, recomputed: {drift}')
+        return drift
+
+
+class _LotCounters:
+    """Last lot number of every symbol, new lot numbers are reserved with atomic $inc."""
+    collection = _collection('lot_counters')
+    indexes = []  # read by _id, the symbol
+
+    def audit_commands(self) -> dict:
+        return {'reserve': {'find': self.collection.name, 'filter': {'_id': ''}, 'limit': 1}}
+
+    @bumps_revision
+    def reserve(self, counts: dict) -> dict:
+        """
+        :param counts: dict, {symbol: number of new lots}.
+        :return: dict, {symbol: first reserved lot number}, first to first + count - 1 are reserved for the caller.
+        """
+        counts = {symbol: count for symbol, count in counts.items() if count}
+        if not counts:
+            return {}
+
+        # counters of symbols added before counters existed start from their last lot number.
+        existing = set(self.collection.distinct('_id', {'_id': {'$in': list(counts)}}))
+        new = [symbol for symbol in counts if symbol not in existing]
+        if new:
+            last_lots = {d['_id']: d['last'] for d in _Stocks.collection.aggregate([
+                {'$match': {'symbol': {'$in': new}}},
+                {'$group': {'_id': '$symbol', 'last': {'$max': '$Lot_Num'}}},
+            ])}
+            self.collection.bulk_write([UpdateOne({'_id': symbol}, {'$setOnInsert': {'last': last_lots.get(symbol, 0)}},
+                                                  upsert=True) for symbol in new], ordered=False)
+
+        first = {}
+        for symbol, count in counts.items():
+            d = self.collection.find_one_and_update({'_id': symbol}, {'$inc': {'last': count}},
+                                                    return_document=ReturnDocument.AFTER)
+            first[symbol] = d['last'] - count + 1
+        return first
+
+    @bumps_revision
+    def reset(self, symbol: str, last: int):
+        """set last lot number of symbol, after its lots were renumbered"""
+        self.collection.update_one({'_id': symbol}, {'$set': {'last': last}}, upsert=True)
@@ -0,0 +1,140 @@
+"""
+Run named stages by their dependencies (DAG) on a thread pool, independent stages run at the same time.
+Every run records wall time of each stage and the critical path, the chain of stages that bounded the run.
+"""
+import concurrent.futures
+import time
+
+from exceptions import logging, sys, PipelineError
+
+LOG = logging.getLogger('Pipeline.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+
+class Stage:
+    def __init__(self, name: str, func, depends_on=()):
+        """
+        :param name: str, unique stage name.
+        :param func: callable, called with results of depends_on stages as keyword arguments.
+        :param depends_on: iterable of stage names that must finish successfully before this stage.
+        """
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+
+class PipelineRun:
+    """Results and timing of one Pipeline.run."""
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}  # stage name: exception
+        self.skipped = []  # stages not run because a dependency failed
+        self.started = {}  # stage name: seconds from run start
+        self.finished = {}
+        self.wall_time = 0.0
+        self.critical_path = []
+
+    def stage_times(self) -> dict:
+        return {name: self.finished[name] - self.started[name] for name in self.finished}
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise PipelineError(f'Stages failed: {", ".join(self.errors)}, skipped: {", ".join(self.skipped)}') \
+                from next(iter(self.errors.values()))
+
+
+class Pipeline:
+    def __init__(self, stages: list):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f'Duplicate stage name {stage.name}')
+            self.stages[stage.name] = stage
+
+        for stage in stages:
+            unknown = set(stage.depends_on) - set(self.stages)
+            if unknown:
+                raise ValueError(f'Stage {stage.name} depends on unknown stages {", ".join(sorted(unknown))}')
+        self._check_cycles()
+
+    def _check_cycles(self):
+        done, visiting = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f'Dependency cycle through stage {name}')
+            visiting.add(name)
+            for dep in self.stages[name].depends_on:
+                visit(dep)
+            visiting.remove(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _run_stage(self, stage: Stage, run: PipelineRun, t0: float):
+        run.started[stage.name] = time.perf_counter() - t0
+        try:
+            return stage.func(**{dep: run.results[dep] for dep in stage.depends_on})
+        finally:
+            run.finished[stage.name] = time.perf_counter() - t0
+
+    def run(self, max_workers: int = None) -> PipelineRun:
+        """
+        Run all stages, a stage starts when all its dependencies finished.
+        Stages that depend on a failed or skipped stage are skipped, other stages keep running.
+        :param max_workers: int, thread pool size, ThreadPoolExecutor default if not given.
+        :return: PipelineRun.
+        """
+        run = PipelineRun()
+        pending = dict(self.stages)
+        running = {}
+        t0 = time.perf_counter()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    deps = stage.depends_on
+                    if any(dep in run.errors or dep in run.skipped for dep in deps):
+                        LOG.warning(f'Stage {name} skipped, dependency failed')
+                        run.skipped.append(name)
+                        del pending[name]
+                    elif all(dep in run.results for dep in deps):
+                        LOG.debug(f'Stage {name} started')
+                        running[executor.submit(self._run_stage, stage, run, t0)] = name
+                        del pending[name]
+
+                if not running:  # only skipped stages were left
+                    continue
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        run.results[name] = future.result()
+                        LOG.info(f'Stage {name} finished in {run.finished[name] - run.started[name]:.2f}s')
+                    except Exception as e:
+                        run.errors[name] = e
+                        LOG.exception(f'Stage {name} failed', exc_info=e)
+
+        run.wall_time = time.perf_counter() - t0
+        run.critical_path = self._critical_path(run)
+        LOG.info(f'Pipeline finished in {run.wall_time:.2f}s, critical path: {" -> ".join(run.critical_path)}')
+        return run
+
+    def _critical_path(self, run: PipelineRun) -> list:
+        """from last finished stage, back through the dependency that finished last"""
+        if not run.finished:
+            return []
+        name = max(run.finished, key=run.finished.get)
+        path = [name]
+        while True:
+            deps = [dep for dep in self.stages[name].depends_on if dep in run.finished]
+            if not deps:
+                return path[::-1]
+            name = max(deps, key=run.finished.get)
+            path.append(name)
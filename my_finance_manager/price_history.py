@@ -0,0 +1,134 @@
+"""
+Local store of daily close prices, kept between runs.
+Every symbol has two append-only files, dates index (datetime64[D]) and closes (float64),
+read back as memory-mapped arrays, so reads are slices of the files with no copy.
+Symbols are backfilled once, then sync downloads only days after the last stored close.
+"""
+import numpy as np
+
+from exceptions import logging, os, sys, datetime
+
+LOG = logging.getLogger('Price.History.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+DATES_DTYPE = np.dtype('datetime64[D]')
+CLOSES_DTYPE = np.dtype(np.float64)
+
+
+def read_memmap(file_path: str, dtype, length: int = None) -> np.ndarray:
+    """
+    :param length: int, max items, items after it are not read.
+    :return: numpy array, memory-mapped items of append-only file, empty if file is missing or empty.
+    """
+    size = os.path.getsize(file_path) // dtype.itemsize if os.path.exists(file_path) else 0
+    if length is not None:
+        size = min(size, length)
+    if not size:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r', shape=(size,))
+
+
+class PriceHistoryStore:
+    def __init__(self, path: str = 'media/price_history/', source=None, backfill_days: int = 5 * 365):
+        """
+        :param path: str, folder of symbols files, created on first append.
+        :param source: object with get_history(symbols, start), like YahooQuoteProvider.
+        :param backfill_days: int, days of history downloaded for a new symbol.
+        """
+        self.path = path
+        self.source = source
+        self.backfill_days = backfill_days
+
+    def _files(self, symbol) -> tuple:
+        name = str(symbol).replace('/', '_')
+        return os.path.join(self.path, f'{name}.dates'), os.path.join(self.path, f'{name}.closes')
+
+    def dates(self, symbol) -> np.ndarray:
+        """:return: numpy datetime64[D] array, stored days of symbol, sorted."""
+        return read_memmap(self._files(symbol)[0], DATES_DTYPE)
+
+    def closes(self, symbol) -> np.ndarray:
+        """:return: numpy float64 array, close of every day in dates(symbol)."""
+        # dates file is written last, so closes of an interrupted append are not read.
+        return read_memmap(self._files(symbol)[1], CLOSES_DTYPE, length=len(self.dates(symbol)))
+
+    def last_date(self, symbol):
+        """:return: numpy datetime64[D] of last stored day, None if symbol has no history."""
+        dates = self.dates(symbol)
+        return dates[-1] if len(dates) else None
+
+    def window(self, symbol, start=None, end=None) -> tuple:
+        """
+        :param start: first day, date or 'YYYY-MM-DD', from first stored day if not given.
+        :param end: last day, included, to last stored day if not given.
+        :return: tuple, (dates, closes) memory-mapped slices of days between start and end.
+        """
+        dates, closes = self.dates(symbol), self.closes(symbol)
+        i = np.searchsorted(dates, np.datetime64(start, 'D')) if start is not None else 0
+        j = np.searchsorted(dates, np.datetime64(end, 'D'), side='right') if end is not None else len(dates)
+        return dates[i:j], closes[i:j]
+
+    def close_on(self, symbol, date) -> float:
+        """:return: float, close of date or last close before it, nan if no close stored until date."""
+        dates = self.dates(symbol)
+        i = np.searchsorted(dates, np.datetime64(date, 'D'), side='right')
+        return float(self.closes(symbol)[i - 1]) if i else float('nan')
+
+    def append(self, symbol, dates, closes) -> int:
+        """
+        Append closes of days after last stored day, earlier days are ignored.
+        :param dates: array like of days, sorted.
+        :param closes: array like of floats, same length as dates.
+        :return: int, appended days count.
+        """
+        dates = np.asarray(dates, dtype=DATES_DTYPE)
+        closes = np.asarray(closes, dtype=CLOSES_DTYPE)
+        last = self.last_date(symbol)
+        if last is not None:
+            new = dates > last
+            dates, closes = dates[new], closes[new]
+        if not len(dates):
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+        dates_file, closes_file = self._files(symbol)
+        stored = len(self.dates(symbol))
+        with open(closes_file, 'ab') as f:
+            f.truncate(stored * CLOSES_DTYPE.itemsize)  # drop closes of an interrupted append
+            f.write(closes.tobytes())
+        with open(dates_file, 'ab') as f:
+            f.write(dates.tobytes())
+        return len(dates)
+
+    def sync(self, symbols, today: datetime.date = None) -> dict:
+        """
+        Download missing days of symbols until yesterday, today close is still changing.
+        New symbols are backfilled, all symbols are downloaded in one request from the earliest missing day.
+        :param symbols: iterable of symbols.
+        :param today: datetime.date, for tests.
+        :return: dict, {symbol: appended days count}.
+        """
+        today = np.datetime64(today or datetime.date.today(), 'D')
+        backfill_start = today - np.timedelta64(self.backfill_days, 'D')
+
+        starts = {}
+        for symbol in set(symbols):
+            last = self.last_date(symbol)
+            start = backfill_start if last is None else last + np.timedelta64(1, 'D')
+            if start < today:
+                starts[symbol] = start
+        if not starts:
+            return {}
+
+        start = min(starts.values())
+        LOG.debug(f'Syncing price history of {len(starts)} symbols from {start}')
+        history = self.source.get_history(starts, start.astype(datetime.date))
+
+        appended = {}
+        for symbol, (dates, closes) in history.items():
+            dates, closes = np.asarray(dates, dtype=DATES_DTYPE), np.asarray(closes, dtype=CLOSES_DTYPE)
+            completed = dates < today
+            appended[symbol] = self.append(symbol, dates[completed], closes[completed])
+        LOG.info(f'Price history synced, {sum(appended.values())} new closes of {len(appended)} symbols')
+        return appended
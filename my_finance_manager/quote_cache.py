@@ -0,0 +1,144 @@
+"""
+Persistent cache of quotes and currency rates, in a local SQLite file shared by all MFM processes,
+so a GUI restart or a rerun of the schedule script reuses fresh prices instead of requesting them again.
+A value is fresh for open_ttl seconds while its source market is open,
+after market close a value stored after the close stays fresh until the market opens again.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from zoneinfo import ZoneInfo  # Python 3.9+, time zones of Windows come from tzdata package
+
+from exceptions import logging, os, sys, datetime
+
+LOG = logging.getLogger('Quote.Cache.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# source: (market timezone, trading weekdays, open time, close time)
+MARKET_HOURS = {
+    'yahoo': ('America/New_York', (0, 1, 2, 3, 4), datetime.time(9, 30), datetime.time(16, 0)),
+    'bizportal': ('Asia/Jerusalem', (0, 1, 2, 3, 4), datetime.time(9, 59), datetime.time(17, 25)),
+    # daily reference rates, published around 16:00 CET.
+    'fx': ('Europe/Berlin', (0, 1, 2, 3, 4), datetime.time(0, 0), datetime.time(16, 0)),
+}
+
+_lock = threading.Lock()
+_shared_cache = None
+
+
+def last_close(source: str, now: datetime.datetime):
+    """:return: datetime, last market close of source before now, None if source has no market hours."""
+    if source not in MARKET_HOURS:
+        return None
+    tz, weekdays, _, close = MARKET_HOURS[source]
+    now = now.astimezone(ZoneInfo(tz))
+    for days_back in range(8):
+        day = now.date() - datetime.timedelta(days=days_back)
+        close_at = datetime.datetime.combine(day, close, tzinfo=now.tzinfo)
+        if day.weekday() in weekdays and close_at <= now:
+            return close_at
+
+
+def market_open(source: str, now: datetime.datetime) -> bool:
+    """:return: True if source market is open at now, sources with no market hours are always open."""
+    if source not in MARKET_HOURS:
+        return True
+    tz, weekdays, open_time, close = MARKET_HOURS[source]
+    now = now.astimezone(ZoneInfo(tz))
+    return now.weekday() in weekdays and open_time <= now.time() < close
+
+
+class QuoteCache:
+    max_variables = 999  # limit of variables in one statement of SQLite before 3.32
+
+    def __init__(self, path: str = 'media/quote_cache.sqlite3', open_ttl: float = 300, clock=time.time):
+        """
+        :param path: str, SQLite file, created on first use.
+        :param open_ttl: float, seconds a value is fresh while its market is open.
+        :param clock: callable, epoch seconds clock, for tests.
+        """
+        self.path = path
+        self.open_ttl = open_ttl
+        self.clock = clock
+        self._created = False
+        self.hits = self.misses = 0
+
+    def _connect(self):
+        # a connection per call, so threads of the pipeline and other processes can use the same file.
+        if not self._created:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._created:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS quotes (source TEXT, key TEXT, value TEXT, stored_at REAL, '
+                         'PRIMARY KEY (source, key))')
+            self._created = True
+        return conn
+
+    def is_fresh(self, source: str, stored_at: float) -> bool:
+        now = datetime.datetime.fromtimestamp(self.clock(), datetime.timezone.utc)
+        if market_open(source, now):
+            return now.timestamp() - stored_at < self.open_ttl
+        return datetime.datetime.fromtimestamp(stored_at, datetime.timezone.utc) >= last_close(source, now)
+
+    def get_many(self, source: str, keys) -> dict:
+        """
+        :param source: str, like 'yahoo'.
+        :param keys: iterable of symbols or fund ids.
+        :return: dict, {key: value} of fresh cached keys only.
+        """
+        keys = {str(key): key for key in keys}
+        if not keys:
+            return {}
+        rows = []
+        str_keys = list(keys)
+        with closing(self._connect()) as conn:
+            for i in range(0, len(str_keys), self.max_variables - 1):
+                chunk = str_keys[i:i + self.max_variables - 1]
+                rows += conn.execute(f'SELECT key, value, stored_at FROM quotes WHERE source = ? '
+                                     f'AND key IN ({", ".join("?" * len(chunk))})', [source, *chunk]).fetchall()
+
+        values = {keys[key]: json.loads(value) for key, value, stored_at in rows if self.is_fresh(source, stored_at)}
+        self.hits += len(values)
+        self.misses += len(keys) - len(values)
+        return values
+
+    def set_many(self, source: str, values: dict):
+        """:param values: dict, {key: json serializable value}."""
+        if not values:
+            return
+        stored_at = self.clock()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO quotes VALUES (?, ?, ?, ?)',
+                             [(source, str(key), json.dumps(value), stored_at) for key, value in values.items()])
+
+    def get(self, source: str, key):
+        """:return: fresh cached value of key, None if missing or stale."""
+        return self.get_many(source, [key]).get(key)
+
+    def set(self, source: str, key, value):
+        self.set_many(source, {key: value})
+
+    def clear(self, source: str = None):
+        with closing(self._connect()) as conn, conn:
+            if source:
+                conn.execute('DELETE FROM quotes WHERE source = ?', [source])
+            else:
+                conn.execute('DELETE FROM quotes')
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def shared_cache() -> QuoteCache:
+    """QuoteCache of the process, created on first use"""
+    global _shared_cache
+    with _lock:
+        if _shared_cache is None:
+            _shared_cache = QuoteCache()
+    return _shared_cache
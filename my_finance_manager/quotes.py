@@ -0,0 +1,481 @@
+"""
+Quote providers and currency rate snapshots for portfolio prices.
+Providers get a collection of symbols and return {symbol: last price} for all of them in one request,
+so a full portfolio refresh costs one round trip per source instead of one per lot.
+"""
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+from circuit_breaker import circuit_breaker
+from exceptions import logging, sys, datetime, CircuitOpenError
+from http_client import HttpClient, shared_client
+from rate_limiter import rate_limiter
+
+LOG = logging.getLogger('Quotes.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+_lock = threading.Lock()
+_router_executor = None
+
+
+def router_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """thread pool of the process for QuoteRouter requests, created on first use, so routers leave no threads"""
+    global _router_executor
+    with _lock:
+        if _router_executor is None:
+            _router_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='quote-router')
+    return _router_executor
+
+
+def _cached_prices(cache, source: str, symbols, download) -> dict:
+    """prices of symbols from cache, download(missing symbols) is called only for symbols with no fresh price"""
+    if cache is None:
+        return download(symbols)
+
+    prices = cache.get_many(source, symbols)
+    missing = [symbol for symbol in symbols if symbol not in prices]
+    if prices:
+        LOG.debug(f'{len(prices)} {source} prices from cache, {len(missing)} to request')
+    downloaded = download(missing) if missing else {}
+    cache.set_many(source, downloaded)
+    return {**prices, **downloaded}
+
+
+class YahooQuoteProvider:
+    """Last close prices of USD symbols from yahoo finance, all symbols in one multi-ticker download."""
+    _download_lock = threading.Lock()  # yfinance keeps results of a download in module globals
+
+    def __init__(self, cache=None):
+        """:param cache: quote_cache.QuoteCache, fresh cached prices are not requested again."""
+        self.cache = cache
+        self.requests_count = 0
+
+    def get_prices(self, symbols) -> dict:
+        """
+        :param symbols: iterable of str, like ['VTI', 'IJR'].
+        :return: dict, {symbol: float}, symbols with no quote are left out.
+        """
+        return _cached_prices(self.cache, 'yahoo', set(symbols), self._download_prices)
+
+    def _download_prices(self, symbols) -> dict:
+        import pandas as pd
+        import yfinance as yf
+
+        breaker = circuit_breaker('yahoo')
+        symbols = sorted(symbol for symbol in set(symbols) if symbol not in breaker.negative_cache)
+        if not symbols:
+            return {}
+        if not breaker.allow():
+            LOG.warning(f'yahoo circuit breaker is {breaker.state}, {len(symbols)} symbols not priced')
+            return {}
+
+        LOG.debug(f'Getting prices for {len(symbols)} symbols with yfinance')
+        rate_limiter('yahoo').acquire()
+        self.requests_count += 1
+        try:
+            with self._download_lock:
+                data = yf.download(tickers=' '.join(symbols), period='5d', group_by='column', progress=False)
+        except Exception:
+            LOG.exception('Error while trying to get prices from yfinance')
+            breaker.record_failure()
+            return {}
+
+        close = data['Close'] if not data.empty else pd.DataFrame()
+        if isinstance(close, pd.Series):  # single ticker download returns flat columns
+            close = close.to_frame(name=symbols[0])
+        close = close.dropna(how='all')  # days with no close of any symbol
+        if close.empty:  # not a missing quote of some symbols, they are not negative cached
+            LOG.warning(f'yfinance returned no quotes for {len(symbols)} symbols')
+            breaker.record_failure()
+            return {}
+
+        last_close = close.ffill().iloc[-1]
+        prices = {symbol: float(price) for symbol, price in last_close.items() if pd.notna(price)}
+        breaker.record_success()  # at least one price, close has a day with a close
+
+        missing = set(symbols) - set(prices)
+        if missing:
+            LOG.warning(f'No quotes found for {", ".join(sorted(missing))}')
+            for symbol in missing:
+                breaker.negative_cache.add(symbol)
+        return prices
+
+    def get_history(self, symbols, start) -> dict:
+        """
+        Daily closes of symbols from start date, all symbols in one multi-ticker download.
+        :param symbols: iterable of str.
+        :param start: datetime.date, first day to download.
+        :return: dict, {symbol: (numpy datetime64[D] dates, numpy float64 closes)}, days with no close are left out.
+        """
+        import pandas as pd
+        import yfinance as yf
+
+        breaker = circuit_breaker('yahoo')
+        symbols = sorted(set(symbols))
+        if not symbols or not breaker.allow():
+            return {}
+
+        LOG.debug(f'Getting daily closes from {start} for {len(symbols)} symbols with yfinance')
+        rate_limiter('yahoo').acquire()
+        self.requests_count += 1
+        try:
+            with self._download_lock:
+                data = yf.download(tickers=' '.join(symbols), start=str(start), group_by='column', progress=False)
+        except Exception:
+            LOG.exception('Error while trying to get price history from yfinance')
+            breaker.record_failure()
+            return {}
+        if data.empty:
+            LOG.warning(f'yfinance returned no daily closes for {len(symbols)} symbols')
+            breaker.record_failure()
+            return {}
+        breaker.record_success()
+
+        close = data['Close']
+        if isinstance(close, pd.Series):
+            close = close.to_frame(name=symbols[0])
+
+        history = {}
+        for symbol in close.columns:
+            closes = close[symbol].dropna()
+            history[symbol] = (closes.index.values.astype('datetime64[D]'), closes.to_numpy(dtype=np.float64))
+        return history
+
+
+class BizPortalQuoteProvider:
+    """
+    Redemption prices of TASE funds from BizPortal API, in agorot.
+    All funds are fetched concurrently with asyncio, at most max_concurrency requests at a time.
+    Requests run on one event loop thread of the provider, with one session and keep-alive pool for all calls,
+    so they can be made from pool threads, like redemption router requests.
+    """
+    url = 'http://externalapi.bizportal.co.il/mobile/m/GetQuote?id={fund_id}'
+
+    def __init__(self, max_concurrency: int = 8, timeout: float = 10, url: str = None, client=None, cache=None,
+                 retries: int = 3, backoff_factor: float = 0.5):
+        """
+        :param max_concurrency: int, max requests at the same time, also max open connections.
+        :param timeout: float, seconds for each request.
+        :param url: str, API url with {fund_id} placeholder, for testing with local server.
+        :param client: http_client.HttpClient that counts requests and connections, shared client if not given.
+        :param cache: quote_cache.QuoteCache, fresh cached prices are not requested again.
+        :param retries: int, retries of timeouts, failed connections and RETRY_STATUSES responses, like HttpClient.
+        :param backoff_factor: float, retry n waits backoff_factor * 2 ** (n - 1) seconds.
+        """
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.url = url or self.url
+        self.client = client
+        self.cache = cache
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.requests_count = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+
+    async def _get(self, fund_id) -> float:
+        """one request, retried with exponential backoff like HttpClient"""
+        import aiohttp
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            await rate_limiter('bizportal').acquire_async()
+            self.requests_count += 1
+            try:
+                async with self._session.get(self.url.format(fund_id=fund_id)) as r:
+                    if r.status in HttpClient.RETRY_STATUSES and attempt < self.retries:
+                        LOG.debug(f'BizPortal API answered {r.status} for {fund_id}, retrying')
+                        continue
+                    r.raise_for_status()
+                    data = await r.json(content_type=None)
+                    return float(data['Quote']['RedPrice'])
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                if attempt == self.retries:
+                    raise
+                LOG.debug(f'BizPortal API request for {fund_id} failed, {e!r}, retrying')
+
+    async def _fetch(self, fund_id) -> float:
+        breaker = circuit_breaker('bizportal')
+        async with self._semaphore:
+            if not breaker.allow(fund_id):
+                raise CircuitOpenError(f'bizportal circuit breaker is {breaker.state}')
+
+            try:
+                price = await self._get(fund_id)
+            except Exception:
+                breaker.record_failure(fund_id)
+                raise
+            breaker.record_success()
+            return price
+
+    async def _fetch_all(self, fund_ids: list) -> dict:
+        import aiohttp
+
+        if self._session is None:  # session and semaphore are bound to the event loop of the provider
+            client = self.client or shared_client()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),  # keep-alive pool for all calls
+                trace_configs=[client.aiohttp_trace_config()])
+        results = await asyncio.gather(*[self._fetch(fund_id) for fund_id in fund_ids], return_exceptions=True)
+
+        prices = {}
+        for fund_id, result in zip(fund_ids, results):
+            if isinstance(result, CircuitOpenError):
+                LOG.debug(f'Redemption price for {fund_id} skipped, {result}')
+            elif isinstance(result, Exception):
+                LOG.error(f'Error while trying to get redemption price for {fund_id} from BizPortal API: {result!r}')
+            else:
+                prices[fund_id] = result
+        return prices
+
+    def get_prices(self, fund_ids) -> dict:
+        """
+        :param fund_ids: iterable of int, TASE fund numbers, duplicates are fetched once.
+        :return: dict, {fund_id: float}, funds that failed are left out.
+        """
+        return _cached_prices(self.cache, 'bizportal', list(dict.fromkeys(fund_ids)), self._download_prices)
+
+    def _download_prices(self, fund_ids: list) -> dict:
+        if not fund_ids:
+            return {}
+
+        LOG.debug(f'Getting redemption prices for {len(fund_ids)} funds with BizPortal API')
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, args=(self._loop,), name='bizportal-loop', daemon=True).start()
+                atexit.register(self.close)
+        return asyncio.run_coroutine_threadsafe(self._fetch_all(fund_ids), self._loop).result()
+
+    @staticmethod
+    def _run_loop(loop):
+        loop.run_forever()
+        loop.close()
+
+    def close(self):
+        """close session and stop event loop thread, a later call starts them again"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+class LatencyHistogram:
+    """Rolling window of a source's latest request latencies, in seconds."""
+
+    def __init__(self, window: int = 200):
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, q: float) -> float:
+        """:return: float, q percentile of window latencies, nan if empty."""
+        with self._lock:
+            latencies = list(self._latencies)
+        return float(np.percentile(latencies, q)) if latencies else float('nan')
+
+
+class QuoteRouter:
+    """
+    Get a symbol price from the source with lowest median latency,
+    if it is slower than its rolling p95 send a hedged request to the next source, and take the first answer.
+    Failed requests go on to the next source right away.
+    """
+
+    def __init__(self, sources: dict, hedge_percentile: float = 95, min_samples: int = 20,
+                 default_hedge_delay: float = 2.0, max_workers: int = 8):
+        """
+        :param sources: dict, {source name: callable(symbol) -> float}, in default order of preference.
+        :param hedge_percentile: float, primary latency percentile to wait before hedged request.
+        :param min_samples: int, latencies needed before routing and hedging follow the histograms.
+        :param default_hedge_delay: float, seconds to wait before hedged request while source has few samples.
+        :param max_workers: int, max symbols requested at the same time by get_prices.
+        """
+        self.sources = dict(sources)
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.default_hedge_delay = default_hedge_delay
+        self.histograms = {name: LatencyHistogram() for name in self.sources}
+        self.hedged_count = 0
+        self.wins = collections.Counter()
+        self.max_workers = max_workers
+        self._executor = router_executor()
+
+    def _ranked_sources(self) -> list:
+        """sources by median latency, sources with few samples count as default_hedge_delay latency"""
+        default_order = list(self.sources)
+
+        def rank(name):
+            histogram = self.histograms[name]
+            if len(histogram) < self.min_samples:
+                return self.default_hedge_delay, default_order.index(name)
+            return histogram.percentile(50), default_order.index(name)
+
+        return sorted(default_order, key=rank)
+
+    def _hedge_delay(self, name: str) -> float:
+        histogram = self.histograms[name]
+        if len(histogram) < self.min_samples:
+            return self.default_hedge_delay
+        return histogram.percentile(self.hedge_percentile)
+
+    def _timed_call(self, name: str, symbol):
+        t0 = time.perf_counter()
+        price = self.sources[name](symbol)
+        # latency of successes only, a source that fails fast, like behind an open breaker, is not ranked first.
+        self.histograms[name].record(time.perf_counter() - t0)
+        return price
+
+    def get_price(self, symbol) -> float:
+        """
+        :param symbol: symbol or fund id, passed to sources.
+        :return: float, first successful answer.
+        :raise: last source error if all sources failed.
+        """
+        waiting = self._ranked_sources()
+        running = {}
+        error = None
+
+        while waiting or running:
+            if waiting and (not running or error):
+                name = waiting.pop(0)
+                running[self._executor.submit(self._timed_call, name, symbol)] = name
+                error = None
+
+            # with more sources waiting, wait for the primary only up to its hedge delay.
+            timeout = self._hedge_delay(next(iter(running.values()))) if waiting else None
+            done, _ = concurrent.futures.wait(running, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                name = waiting.pop(0)
+                LOG.debug(f'{symbol}: hedged request to {name}')
+                self.hedged_count += 1
+                running[self._executor.submit(self._timed_call, name, symbol)] = name
+                continue
+
+            for future in done:
+                name = running.pop(future)
+                try:
+                    price = future.result()
+                except Exception as e:
+                    LOG.debug(f'{symbol}: {name} failed, {e!r}')
+                    error = e
+                    continue
+                self.wins[name] += 1
+                return price
+
+        raise error
+
+    def get_prices(self, symbols) -> dict:
+        """
+        :param symbols: iterable, duplicates are fetched once.
+        :return: dict, {symbol: float}, symbols that failed on all sources are left out.
+        """
+        symbols = list(dict.fromkeys(symbols))
+        prices = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.get_price, symbol): symbol for symbol in symbols}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    prices[futures[future]] = future.result()
+                except Exception:
+                    LOG.exception(f'No source answered for {futures[future]}')
+        return prices
+
+    def stats(self) -> dict:
+        """:return: dict, {source: {'count', 'p50', 'p95', 'wins'}}, and hedged requests count."""
+        stats = {name: {'count': len(histogram), 'p50': histogram.percentile(50),
+                        'p95': histogram.percentile(95), 'wins': self.wins[name]}
+                 for name, histogram in self.histograms.items()}
+        stats['hedged'] = self.hedged_count
+        return stats
+
+
+class StaticQuoteProvider:
+    """Fixed prices from a dict, for offline runs and tests."""
+
+    def __init__(self, prices: dict):
+        self.prices = dict(prices)
+        self.requests_count = 0
+
+    def get_prices(self, symbols) -> dict:
+        self.requests_count += 1
+        return {symbol: float(self.prices[symbol]) for symbol in set(symbols) if symbol in self.prices}
+
+
+class FxSnapshot:
+    """
+    Currency rates fetched once per refresh, every conversion of that refresh uses the same rates.
+    Conversions are numpy multiplications, so amount can be a number or an array of amounts.
+    """
+
+    def __init__(self, rates: dict, taken_at: datetime.datetime = None):
+        """
+        :param rates: dict, {(i_have, i_want): rate}, like {('USD', 'ILS'): 3.45}.
+        :param taken_at: datetime, time rates were fetched, now if not given.
+        """
+        self.rates = {(i_have.upper(), i_want.upper()): float(rate) for (i_have, i_want), rate in rates.items()}
+        self.taken_at = taken_at or datetime.datetime.now()
+
+    @classmethod
+    def fetch(cls, currency_rates, pairs=(('USD', 'ILS'),), cache=None):
+        """
+        One rates request per distinct base currency, all needed pairs are read from it.
+        :param currency_rates: forex_python CurrencyRates object.
+        :param pairs: iterable of (i_have, i_want) tuples.
+        :param cache: quote_cache.QuoteCache, fresh cached base rates are not requested again.
+        :return: FxSnapshot.
+        """
+        rates = {}
+        pairs = [(i_have.upper(), i_want.upper()) for i_have, i_want in pairs]
+        bases = sorted({i_have for i_have, _ in pairs})
+        all_rates = _cached_prices(cache, 'fx', bases,
+                                   lambda missing: {base: currency_rates.get_rates(base) for base in missing})
+        for base in bases:
+            base_rates = all_rates[base]
+            for i_have, i_want in pairs:
+                if i_have == base:
+                    rates[(i_have, i_want)] = base_rates[i_want]
+
+        snapshot = cls(rates)
+        LOG.info(f'FX snapshot taken at {snapshot.taken_at:%d-%m-%Y %H:%M:%S}: {snapshot.rates}')
+        return snapshot
+
+    def rate(self, i_have: str, i_want: str) -> float:
+        i_have, i_want = i_have.upper(), i_want.upper()
+        if i_have == i_want:
+            return 1.0
+        if (i_have, i_want) in self.rates:
+            return self.rates[(i_have, i_want)]
+        if (i_want, i_have) in self.rates:
+            return 1 / self.rates[(i_want, i_have)]
+        raise KeyError(f'No rate for {i_have}/{i_want} in FX snapshot')
+
+    def convert(self, i_have: str, i_want: str, amount):
+        """
+        :param amount: float or numpy array.
+        :return: float or numpy array, amount in i_want currency.
+        """
+        return np.multiply(amount, self.rate(i_have, i_want))
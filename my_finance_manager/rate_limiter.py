@@ -0,0 +1,103 @@
+"""
+Token bucket rate limiters for quote sources, one per source for the process.
+A bucket refills rate tokens per second up to burst tokens, every request takes one token.
+Requests that find the bucket empty reserve a token and wait their turn, first come first served,
+from pool threads with acquire or from asyncio tasks with acquire_async.
+Queue wait time of every source is counted, to tune RATE_LIMITS to the fastest rate a source tolerates.
+"""
+import asyncio
+import threading
+import time
+
+from exceptions import logging, sys
+
+LOG = logging.getLogger('Rate.Limiter.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# source: (requests per second, burst)
+RATE_LIMITS = {
+    'yahoo': (2, 4),
+    'bizportal': (10, 10),
+    'maya': (0.5, 1),
+}
+DEFAULT_RATE_LIMIT = (5, 5)
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: int = 1, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param name: str, quote source name, like 'yahoo'.
+        :param rate: float, tokens added per second.
+        :param burst: int, max tokens in bucket, requests sent at once after idle time.
+        :param clock: callable, seconds clock, for tests.
+        :param sleep: callable, sleeps given seconds, for tests.
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated_at = clock()
+        self.acquired_count = 0
+        self.waited_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _reserve(self) -> float:
+        """take a token, tokens below zero are reserved by waiting requests. :return: float, seconds to wait."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+
+            self.acquired_count += 1
+            if wait:
+                self.waited_count += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self) -> float:
+        """Block thread until request may be sent. :return: float, seconds waited in queue."""
+        wait = self._reserve()
+        if wait:
+            LOG.debug(f'{self.name} request waits {wait:.2f}s for rate limit')
+            self.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        """Suspend task until request may be sent, other tasks keep running. :return: float, seconds waited."""
+        wait = self._reserve()
+        if wait:
+            LOG.debug(f'{self.name} request waits {wait:.2f}s for rate limit')
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        mean_wait = self.total_wait / self.acquired_count if self.acquired_count else 0.0
+        return {'rate': self.rate, 'acquired': self.acquired_count, 'waited': self.waited_count,
+                'total_wait': round(self.total_wait, 3), 'mean_wait': round(mean_wait, 3),
+                'max_wait': round(self.max_wait, 3)}
+
+
+def rate_limiter(name: str) -> TokenBucket:
+    """TokenBucket of quote source name for the process, created on first use from RATE_LIMITS"""
+    with _lock:
+        if name not in _limiters:
+            rate, burst = RATE_LIMITS.get(name, DEFAULT_RATE_LIMIT)
+            _limiters[name] = TokenBucket(name, rate, burst)
+        return _limiters[name]
+
+
+def limiters_stats() -> dict:
+    with _lock:
+        return {name: limiter.stats() for name, limiter in _limiters.items()}
@@ -0,0 +1,94 @@
+"""
+Vectorized revaluation of portfolio lots.
+All lots are loaded to one frame and priced at once with numpy array operations,
+against one quotes result and one FxSnapshot, instead of one lot at a time.
+"""
+import numpy as np
+import pandas as pd
+
+from exceptions import logging, sys
+from mongo_db import Lot
+
+LOG = logging.getLogger('Revaluation.Logger')
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+REVALUED_COLUMNS = ['Market_Value_USD', 'Market_Value_ILS', 'Profit_%', 'Profit_ILS', 'Profit_USD']
+
+
+def lots_frame(lots) -> pd.DataFrame:
+    """
+    :param lots: list of mongo_db.Lot, from _Stocks.load_lots.
+    :return: DataFrame with Lot fields as columns, one row per lot.
+    """
+    df = pd.DataFrame(data=lots, columns=Lot._fields)
+    df.amount = df.amount.astype(float)
+    df.buy_price = df.buy_price.astype(float)
+    return df
+
+
+def _lot_prices(df: pd.DataFrame, usd_prices: dict, ils_prices: dict) -> np.ndarray:
+    """price of every lot, USD lots by symbol and ILS lots by tase_index, nan for lots without a price"""
+    return np.where((df.currency == 'ILS').to_numpy(),
+                    df.tase_index.map(ils_prices).to_numpy(dtype=float, na_value=np.nan),
+                    df.symbol.map(usd_prices).to_numpy(dtype=float, na_value=np.nan))
+
+
+def quote_records(df: pd.DataFrame, usd_prices: dict, ils_prices: dict) -> dict:
+    """
+    Latest price of every symbol of lots, for quotes collection in derived on read storage mode.
+    :return: dict, {symbol: {'Price': float, 'Currency': str}}, symbols without a price are left out.
+    """
+    df = df.drop_duplicates('symbol')
+    price = _lot_prices(df, usd_prices, ils_prices)
+    has_price = ~np.isnan(price)
+    if not has_price.all():
+        LOG.warning(f'No price for {", ".join(sorted(df.symbol[~has_price]))}, quotes not updated')
+    return {symbol: {'Price': float(p), 'Currency': currency}
+            for symbol, currency, p in zip(df.symbol[has_price], df.currency[has_price], price[has_price])}
+
+
+def revalue(df: pd.DataFrame, usd_prices: dict, ils_prices: dict, fx) -> pd.DataFrame:
+    """
+    Compute market values and profits of all lots with array operations.
+    USD lots are priced by symbol, ILS (TASE) lots by tase_index in agorot, like in add_stock.
+    :param df: DataFrame from lots_frame.
+    :param usd_prices: dict, {symbol: price in USD}.
+    :param ils_prices: dict, {tase_index: redemption price in agorot}.
+    :param fx: FxSnapshot.
+    :return: DataFrame with _id, symbol, Lot_Num and REVALUED_COLUMNS, lots without a price are left out.
+    """
+    is_ils = (df.currency == 'ILS').to_numpy()
+    price = _lot_prices(df, usd_prices, ils_prices)
+
+    has_price = ~np.isnan(price)
+    if not has_price.all():
+        LOG.warning(f'No price for {", ".join(sorted(set(df.symbol[~has_price])))}, lots not revalued')
+    df, price, is_ils = df[has_price], price[has_price], is_ils[has_price]
+
+    amount = df.amount.to_numpy()
+    scale = np.where(is_ils, 0.01, 1.0)  # TASE prices are in agorot
+    start_market_val = df.buy_price.to_numpy() * amount * scale
+    current_market_val = price * amount * scale
+
+    # rate from lot currency to the other one, ILS -> USD or USD -> ILS
+    rate = np.where(is_ils, fx.rate('ILS', 'USD'), fx.rate('USD', 'ILS'))
+    converted_c_market_val = np.round(current_market_val * rate, 3)
+    profit = np.round(current_market_val - start_market_val, 3)
+    converted_profit = np.round(profit * rate, 3)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profit_percentage = np.round(((current_market_val / start_market_val) * 100) - 100, 3)
+    # no percentage of a free lot, None like the derived on read pipeline, not inf
+    profit_percentage = np.where(start_market_val == 0, None, profit_percentage)
+
+    return pd.DataFrame({
+        '_id': df.lot_id.to_numpy(),
+        'symbol': df.symbol.to_numpy(),
+        'Lot_Num': df.lot_num.to_numpy(),
+        'Market_Value_USD': np.where(is_ils, converted_c_market_val, current_market_val),
+        'Market_Value_ILS': np.where(is_ils, current_market_val, converted_c_market_val),
+        'Profit_%': profit_percentage,
+        'Profit_ILS': np.where(is_ils, profit, converted_profit),
+        'Profit_USD': np.where(is_ils, converted_profit, profit),
+    })
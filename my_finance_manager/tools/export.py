@@ -0,0 +1,128 @@
+"""
+Export MFM database collections, one file per collection, for moving a portfolio between machines and analytics.
+Collections are streamed through cursors with batch_size documents per round trip, and written as they arrive:
+    ndjson - one extended JSON document per line, types like dates are kept, tools.json_to_mongo imports it back.
+    parquet - one row group per batch, after a first pass that reads the schema of all documents, needs pyarrow.
+Run from my_finance_manager folder:
+    python -m tools.export OUT_DIR [--format ndjson|parquet] [--batch-size N] [--collections NAME ...]
+"""
+import argparse
+import time
+
+from bson import json_util
+
+from exceptions import os
+from mongo_db import MyMongoDB
+
+
+def _batches(cursor, size: int):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_ndjson(collection, path: str, batch_size: int) -> int:
+    """:return: int, exported documents count."""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for doc in collection.find({}).batch_size(batch_size):
+            f.write(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def _mixed_fields(batch: list) -> set:
+    """top level fields with str and other values, like TASE_INDEX of funds and currencies"""
+    types = {}
+    for doc in batch:
+        for field, value in doc.items():
+            if value is not None:
+                types.setdefault(field, set()).add(type(value))
+    return {field for field, field_types in types.items() if str in field_types and len(field_types) > 1}
+
+
+def _to_strings(batch: list, fields: set):
+    """ObjectId _id and values of fields are written as strings"""
+    for doc in batch:
+        doc['_id'] = str(doc['_id'])
+        for field in fields & doc.keys():
+            if doc[field] is not None:
+                doc[field] = str(doc[field])
+
+
+def _parquet_schema(collection, batch_size: int) -> tuple:
+    """
+    Schema of all documents, from a first pass over the collection, so fields that appear only in later batches
+    are kept, and fields with str values in some batches and other values in others are strings.
+    :return: tuple, (pyarrow schema, set of string fields).
+    :raise: pyarrow.ArrowTypeError if a field has types that can not be unified, like a number and a list.
+    """
+    import pyarrow as pa
+
+    schemas, string_fields = [], set()
+    for batch in _batches(collection.find({}).batch_size(batch_size), batch_size):
+        string_fields |= _mixed_fields(batch)
+        _to_strings(batch, _mixed_fields(batch))
+        schema = pa.Table.from_pylist(batch).schema
+        string_fields |= {field.name for field in schema if pa.types.is_string(field.type)}
+        schemas.append(schema)
+
+    # fields that are strings in any batch are strings in all batches.
+    schemas = [pa.schema([pa.field(field.name, pa.string()) if field.name in string_fields else field
+                          for field in schema]) for schema in schemas]
+    return pa.unify_schemas(schemas, promote_options='permissive') if schemas else pa.schema([]), string_fields
+
+
+def export_parquet(collection, path: str, batch_size: int) -> int:
+    """
+    Schema is taken from a first pass over all documents, missing fields are null.
+    Fields with mixed str and other values are written as strings.
+    :return: int, exported documents count.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema, string_fields = _parquet_schema(collection, batch_size)
+    if not len(schema):
+        return 0
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in _batches(collection.find({}).batch_size(batch_size), batch_size):
+            _to_strings(batch, string_fields)
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export MFM database collections')
+    parser.add_argument('out_dir')
+    parser.add_argument('--format', choices=['ndjson', 'parquet'], default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per cursor batch and row group')
+    parser.add_argument('--collections', nargs='*', help='collection names, all MFM collections if not given')
+    args = parser.parse_args()
+
+    mongo = MyMongoDB()
+    names = args.collections or [dao.collection.name for dao in mongo._daos()]
+    export = export_ndjson if args.format == 'ndjson' else export_parquet
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    total = 0
+    for name in names:
+        count = export(mongo.db[name], os.path.join(args.out_dir, f'{name}.{args.format}'), args.batch_size)
+        total += count
+        print(f'{name:<18} {count:>8} documents')
+    seconds = time.perf_counter() - t0
+    print(f'Exported {total} documents in {seconds:.2f}s, {total / seconds if seconds else 0:,.0f} documents/s')
+
+
+if __name__ == '__main__':
+    main()
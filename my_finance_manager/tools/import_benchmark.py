@@ -0,0 +1,63 @@
+"""
+Measure cold start import time of MFM modules, with per-module cost from python -X importtime.
+Run from my_finance_manager folder:
+    python -m tools.import_benchmark [module ...] [--budget SECONDS] [--top N]
+Exit code is 1 when a module import is over budget.
+"""
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULES = ['mongo_db', 'mfm']
+
+
+def import_times(module: str) -> list:
+    """
+    Import module in a new interpreter and parse -X importtime output.
+    :param module: str, like 'mfm'.
+    :return: list of (package, self seconds, cumulative seconds), in import order.
+    """
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                       capture_output=True, text=True)
+    if r.returncode != 0:
+        raise ImportError(f'import {module} failed:\n{r.stderr.splitlines()[-1]}')
+
+    times = []
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        # package name is indented by nesting level, top level imports have no indent
+        times.append((package[1:].rstrip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MFM cold start import benchmark')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--budget', type=float, default=1.0, help='max seconds for importing each module')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        times = import_times(module)
+        end = max(i for i, t in enumerate(times) if t[0] == module)
+        total = times[end][2]
+        status = 'OK' if total <= args.budget else 'OVER BUDGET'
+        over_budget = over_budget or total > args.budget
+
+        print(f'\n{module}: {total:.3f}s (budget {args.budget:.3f}s) {status}')
+        # importtime lists nested imports before their parent, indented 2 spaces per level.
+        start = end
+        while start > 0 and times[start - 1][0].startswith(' '):
+            start -= 1
+        direct = [t for t in times[start:end] if not t[0].startswith('   ')]
+        for package, self_s, cumulative in sorted(direct, key=lambda t: t[2], reverse=True)[:args.top]:
+            print(f'    {package.strip():<40} {cumulative:8.3f}s  (self {self_s:.3f}s)')
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,104 +1,220 @@
+"""
+Import MFM JSON portfolio data (the version before MongoDB) to MongoDB,
+or collections exported by tools.export as ndjson files.
+The file is parsed incrementally, one symbol or history day at a time, and records are written in bounded batches
+of upserts, so memory stays flat for any file size and importing the same file again does not duplicate data.
+Run from my_finance_manager folder:
+    python -m tools.json_to_mongo [PATH] [--batch-size N]
+PATH is a JSON file, an ndjson file or a folder of ndjson files.
+"""
+import argparse
 import json
-import pprint
-import os
+import time
 from datetime import datetime
 
-from pymongo import MongoClient
-
-client = MongoClient()
-client.drop_database('mfm')
-db = client['mfm']
-
-with open('../database/jsons/01.01.2020-Portfolio-Data.json') as f:
-    file_data = json.load(f)
-
-
-    def replace_dots_for_keys(d):
-        new = {}
-        for k, v in d.items():
-            if isinstance(v, dict):
-                v = replace_dots_for_keys(v)
-            new[k.replace('.', '/')] = v
-        return new
-
-
-    def replace_spaces_for_keys(d):
-        new = {}
-        for k, v in d.items():
-            if isinstance(v, dict):
-                v = replace_spaces_for_keys(v)
-            new[k.replace(' ', '_')] = v
-        return new
-
-
-    file_data = replace_dots_for_keys(file_data)
-    file_data = replace_spaces_for_keys(file_data)
-
-stocks, user_info, history_data, last_modified = [], [], [], []
-for d in file_data:
-    if d == 'stocks':
-        for symbol in file_data[d]:
-            for lot in file_data[d][symbol]:
-                if lot != 'Lot_1':
-                    data = file_data[d][symbol][lot]
-                    lot_num = lot.split('_')[1]
-                    data.update({'Lot_Num': int(lot_num)})
-
-                    stocks.append({'symbol': symbol, **data})
-                    index = stocks.index({'symbol': symbol, **data})
-                    stocks[index]['Date'] = \
-                        datetime.strptime(stocks[index]['Date'], '%d.%m.%Y')
-                    if 'num' in stocks[index]:
-                        temp = stocks[index]['num']
-                        del stocks[index]['num']
-                        stocks[index]['TASE_INDEX'] = temp
-                else:
-                    data = file_data[d][symbol][lot]
-                    lot_num = lot.split('_')[1]
-                    data.update({'Lot_Num': int(lot_num)})
-
-                    stocks.append({'symbol': symbol, **data})
-                    index = stocks.index({'symbol': symbol, **data})
-                    stocks[index]['Date'] = datetime.strptime(stocks[index]['Date'], '%d.%m.%Y')
-                    if 'num' in stocks[index]:
-                        temp = stocks[index]['num']
-                        del stocks[index]['num']
-                        stocks[index]['TASE_INDEX'] = temp
-
-    elif d == 'user_email':
-        user_info.append({'email_address': file_data[d], 'user_name': os.getlogin()})
-
-    elif d == 'update_dates':
-        last_modified.extend([{'type': 'stocks'}, {'type': 'bank'}, {'type': 'trader'}])
-
-    elif d == 'history_data':
-        for index, date in enumerate(file_data[d]):
-            history_data.append({
-                'date': datetime.strptime(date, '%d/%m/%Y'),
-                'bank_cf': file_data[d][date]['bank_cf'],
-                'market_value': file_data[d][date]['market_value'],
-                'profit': file_data[d][date]['profit'],
-                'trader_cf': file_data[d][date]['trader_cf'],
-            })
-            ILS, USD = history_data[index]['market_value']['portfolio']
-            history_data[index]['market_value']['portfolio'] = {'ILS': ILS, 'USD': USD}
-            ILS, USD = history_data[index]['market_value']['total_assets']
-            history_data[index]['market_value']['total_assets'] = {'ILS': ILS, 'USD': USD}
-            percentage, ILS = history_data[index]['profit']
-            history_data[index]['profit'] = {'ILS': ILS, 'percentage': percentage}
-
-pprint.pprint(stocks)
-pprint.pprint(history_data)
-pprint.pprint(user_info)
-pprint.pprint(last_modified)
-
-collection_stocks = db['stocks']
-collection_history = db['history_data']
-collection_user_info = db['user_info']
-collection_last_modified = db['last_modified']
-
-for collection, document in zip([collection_stocks, collection_history, collection_user_info, collection_last_modified],
-                                [stocks, history_data, user_info, last_modified]):
-    collection.insert_many(document)
-
-client.close()
+from bson import json_util
+from pymongo import ReplaceOne, UpdateOne
+
+from exceptions import os
+from mongo_db import MyMongoDB
+
+DEFAULT_PATH = '../database/jsons/01.01.2020-Portfolio-Data.json'
+
+
+class JsonStream:
+    """Incremental parser of a JSON object, members of big objects are decoded one at a time."""
+
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """read next chunk, consumed text is dropped. :return: False at end of file."""
+        chunk = self.f.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON file')
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f'Expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}')
+        self.pos += 1
+
+    def value(self):
+        """decode next value, reading more of the file until the value is complete"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number that ends at end of buffer may continue in next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def members(self):
+        """
+        Iterate keys of object at current position,
+        for every key the caller reads its value with value() or members() before the next key.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._peek() == ',':
+                self.pos += 1
+            else:
+                self._expect('}')
+                return
+
+
+def _clean_key(key: str) -> str:
+    """MongoDB keys can not have dots, and spaces are replaced for consistent field names"""
+    return key.replace('.', '/').replace(' ', '_')
+
+
+def _clean_keys(d: dict) -> dict:
+    return {_clean_key(k): _clean_keys(v) if isinstance(v, dict) else v for k, v in d.items()}
+
+
+def stock_docs(symbol: str, lots: dict):
+    for lot, data in _clean_keys(lots).items():
+        doc = {'symbol': symbol, **data, 'Lot_Num': int(lot.split('_')[1])}
+        doc['Date'] = datetime.strptime(doc['Date'], '%d.%m.%Y')
+        if 'num' in doc:
+            doc['TASE_INDEX'] = doc.pop('num')
+        yield ReplaceOne({'symbol': symbol, 'Lot_Num': doc['Lot_Num']}, doc, upsert=True)
+
+
+def history_doc(date: str, data: dict):
+    data = _clean_keys(data)
+    portfolio_ils, portfolio_usd = data['market_value']['portfolio']
+    total_ils, total_usd = data['market_value']['total_assets']
+    percentage, profit_ils = data['profit']
+    doc = {
+        'date': datetime.strptime(date, '%d/%m/%Y'),
+        'bank_cf': data['bank_cf'],
+        'market_value': {'portfolio': {'ILS': portfolio_ils, 'USD': portfolio_usd},
+                         'total_assets': {'ILS': total_ils, 'USD': total_usd}},
+        'profit': {'ILS': profit_ils, 'percentage': percentage},
+        'trader_cf': data['trader_cf'],
+    }
+    return ReplaceOne({'date': doc['date']}, doc, upsert=True)
+
+
+def read_requests(stream: JsonStream):
+    """
+    :return: generator of (collection name, write request), one file section member at a time.
+    All keys are cleaned, like symbols and dates, as by imports of old versions that cleaned the whole file.
+    """
+    for section in map(_clean_key, stream.members()):
+        if section == 'stocks':
+            for symbol in map(_clean_key, stream.members()):
+                for request in stock_docs(symbol, stream.value()):
+                    yield 'stocks', request
+
+        elif section == 'history_data':
+            for date in map(_clean_key, stream.members()):
+                yield 'history_data', history_doc(date, stream.value())
+
+        elif section == 'user_email':
+            yield 'user_info', UpdateOne({'user_name': os.getlogin()},
+                                         {'$set': {'email_address': stream.value()}}, upsert=True)
+
+        elif section == 'update_dates':
+            stream.value()
+            for field_name in ['stocks', 'bank', 'trader']:
+                yield 'last_modified', UpdateOne({'type': field_name},
+                                                 {'$setOnInsert': {'last_modified': datetime.now()}}, upsert=True)
+        else:
+            stream.value()
+
+
+def read_ndjson_requests(path: str):
+    """
+    :param path: str, <collection>.ndjson file or folder of them, from tools.export.
+    :return: generator of (collection name, write request), one line at a time.
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.ndjson')]
+    else:
+        paths = [path]
+
+    for file_path in paths:
+        name = os.path.basename(file_path)[:-len('.ndjson')]
+        with open(file_path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    doc = json_util.loads(line)
+                    yield name, ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+
+
+def write_batches(db, requests, batch_size: int) -> dict:
+    """
+    :param requests: iterable of (collection name, write request).
+    :return: dict, {collection name: written records count}.
+    """
+    batches, counts = {}, {}
+    for name, request in requests:
+        batch = batches.setdefault(name, [])
+        batch.append(request)
+        if len(batch) == batch_size:
+            db[name].bulk_write(batch, ordered=False)
+            counts[name] = counts.get(name, 0) + len(batch)
+            batch.clear()
+
+    for name, batch in batches.items():
+        if batch:
+            db[name].bulk_write(batch, ordered=False)
+            counts[name] = counts.get(name, 0) + len(batch)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import MFM JSON data to MongoDB')
+    parser.add_argument('path', nargs='?', default=DEFAULT_PATH)
+    parser.add_argument('--batch-size', type=int, default=1000, help='max write requests per bulk write')
+    args = parser.parse_args()
+
+    mongo = MyMongoDB()
+    t0 = time.perf_counter()
+    if os.path.isdir(args.path) or args.path.endswith('.ndjson'):
+        counts = write_batches(mongo.db, read_ndjson_requests(args.path), args.batch_size)
+    else:
+        with open(args.path, encoding='utf-8') as f:
+            counts = write_batches(mongo.db, read_requests(JsonStream(f)), args.batch_size)
+    seconds = time.perf_counter() - t0
+
+    # imported lots change totals and last lot numbers, counters are seeded again from lots on next reserve.
+    mongo.totals.recompute()
+    mongo.lot_counters.collection.delete_many({})
+
+    total = sum(counts.values())
+    for name, count in counts.items():
+        print(f'{name:<15} {count:>8} records')
+    print(f'Imported {total} records in {seconds:.2f}s, {total / seconds if seconds else 0:,.0f} records/s')
+
+
+if __name__ == '__main__':
+    main()
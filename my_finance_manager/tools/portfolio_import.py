@@ -0,0 +1,72 @@
+"""
+Import lots from a broker export to MFM portfolio, with MyFinanceManager.add_stocks.
+CSV files have a header row, JSON files are a list of objects, both with fields:
+    symbol, date, amount, buy_price, currency and tase_index for israeli stocks.
+Run from my_finance_manager folder:
+    python -m tools.portfolio_import FILE [--batch-size N]
+"""
+import argparse
+import csv
+import json
+import time
+
+from mfm import MyFinanceManager
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _tase_index(value):
+    """fund number, or currency code of currency lots, 0 for USD stocks"""
+    value = str(value or '').strip()
+    return int(value) if value.isdigit() else value or 0
+
+
+def read_lots(path: str):
+    """
+    :param path: str, .csv or .json file.
+    :return: generator of dicts with add_stock arguments.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = csv.DictReader(f) if path.lower().endswith('.csv') else json.load(f)
+        for row in rows:
+            yield {
+                'symbol': row['symbol'],
+                'date': row['date'],
+                'amount': _number(row['amount']),
+                'buy_price': float(row['buy_price']),
+                'currency': row['currency'],
+                'tase_index': _tase_index(row.get('tase_index')),
+            }
+
+
+def _batches(lots, size: int):
+    batch = []
+    for lot in lots:
+        batch.append(lot)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import lots to MFM portfolio')
+    parser.add_argument('path', help='.csv or .json file')
+    parser.add_argument('--batch-size', type=int, default=5000, help='lots priced and inserted together')
+    args = parser.parse_args()
+
+    portfolio = MyFinanceManager()
+    t0 = time.perf_counter()
+    added = 0
+    for batch in _batches(read_lots(args.path), args.batch_size):
+        added += portfolio.add_stocks(batch)
+        print(f'{added} lots added')
+    print(f'Imported {added} lots in {time.perf_counter() - t0:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
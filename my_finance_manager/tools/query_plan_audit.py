@@ -0,0 +1,23 @@
+"""
+Report MFM database queries that run as collection scans (COLLSCAN) or in-memory sorts (SORT).
+Run from my_finance_manager folder:
+    python -m tools.query_plan_audit
+"""
+from tabulate import tabulate
+
+from mongo_db import MyMongoDB
+
+
+def main():
+    db = MyMongoDB()
+    created = db.ensure_indexes()
+    if created:
+        print(f'Created indexes: {", ".join(created)}')
+
+    report = db.audit_query_plans()
+    rows = [[r['collection'], r['query'], ', '.join(r['problems']) or 'OK'] for r in report]
+    print(tabulate(rows, headers=['Collection', 'Query', 'Plan']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,28 @@
+import asyncio
+import datetime
+import io
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 
+import numpy as np
+from bson import ObjectId
+
+from circuit_breaker import CircuitBreaker
 from mfm import MyFinanceManager, mongo_db
+from history_store import HistoryStore
+from pipeline import Pipeline, Stage
+from price_history import PriceHistoryStore
+from quote_cache import QuoteCache
+from rate_limiter import TokenBucket
+from tools.export import export_ndjson, export_parquet
+from tools.json_to_mongo import JsonStream, read_requests, read_ndjson_requests
+from quotes import StaticQuoteProvider, BizPortalQuoteProvider, QuoteRouter, FxSnapshot
 
 
 class MyTestCase(unittest.TestCase):
@@ -28,6 +49,21 @@ class MyTestCase(unittest.TestCase):
                     self.assertTrue(self.mfm.add_stock('PSAGOT-TA-125', '18.12.2011', 300, 1950.58, 'ILS', 5110788),
                                     msg='Failed to add ILS stock')
 
+    def test_add_stocks_numbers_lots_once(self):
+        self.mfm.quote_provider = StaticQuoteProvider({'BNDX': 70.0, 'ZZZ': 10.0})
+        self.mfm.refresh_fx = lambda: FxSnapshot({('USD', 'ILS'): 3.5})
+        lots_count = len(self.mfm.db.stocks.load_lots(['BNDX']))
+
+        added = self.mfm.add_stocks([{'symbol': symbol, 'date': '18.12.2011', 'amount': 10, 'buy_price': 50,
+                                      'currency': 'USD'} for symbol in ['BNDX', 'ZZZ', 'BNDX']])
+        self.assertEqual(added, 3)
+        self.assertEqual(self.mfm.quote_provider.requests_count, 1, msg='Expected one quote request for all lots')
+        self.assertTrue(self.mfm.add_stock('ZZZ', 'today', 5, 12, 'USD'))
+
+        self.assertEqual([lot.lot_num for lot in self.mfm.db.stocks.load_lots(['BNDX'])][-2:],
+                         [lots_count + 1, lots_count + 2])
+        self.assertEqual([lot.lot_num for lot in self.mfm.db.stocks.load_lots(['ZZZ'])], [1, 2])
+
     def test_remove_stock(self):
         for i in range(2):
             with self.subTest(i=i):
@@ -38,6 +74,30 @@ class MyTestCase(unittest.TestCase):
                     self.assertTrue(self.mfm.remove_stock('IJR', 10),
                                     msg='Failed to remove shares from stock with 2 lots')
 
+    def test_remove_stock_renumbers_lots(self):
+        self.mfm.quote_provider = StaticQuoteProvider({'IJR': 100.0})
+        lots = self.mfm.db.stocks.load_lots(['IJR'])
+        self.assertTrue(self.mfm.remove_stock('IJR', lots[0].amount + 1))
+
+        left = self.mfm.db.stocks.load_lots(['IJR'])
+        self.assertEqual([lot.lot_num for lot in left], list(range(1, len(lots))),
+                         msg='Lots left should be renumbered from 1')
+        self.assertEqual(left[0].amount, lots[1].amount - 1)
+        with self.assertRaises(ValueError):
+            self.mfm.remove_stock('IJR', sum(lot.amount for lot in left) + 1)
+
+    def test_update_stocks_duplicate_lot_nums(self):
+        self.mfm.quote_provider = StaticQuoteProvider({'DUP': 200.0})
+        self.mfm.refresh_fx = lambda: FxSnapshot({('USD', 'ILS'): 3.5})
+        # lots of legacy databases may share a lot number
+        self.mfm.db.stocks.insert_stocks([self.mfm._new_lot('DUP', '18.12.2011', amount, 100, 'USD') | {'Lot_Num': 1}
+                                          for amount in (10, 20)])
+        self.mfm.update_stocks_price(symbol='DUP')
+
+        lots = self.mfm.db.stocks.collection.find({'symbol': 'DUP'})
+        self.assertEqual(sorted((lot['Amount'], lot['Market_Value_USD']) for lot in lots), [(10, 2000), (20, 4000)])
+        self.assertEqual(self.mfm.db.totals.check_drift(), {})
+
     def test_update_stocks(self):
         for i in range(2):
             with self.subTest(i=i):
@@ -48,10 +108,71 @@ class MyTestCase(unittest.TestCase):
                     self.assertTrue(self.mfm.update_stocks_price(symbol='VTI'),
                                     msg='Failed to update specific stock price')
 
+    def test_update_stocks_offline_quotes(self):
+        usd_symbols = self.mfm.db.stocks.get_stocks_names(currency='USD')
+        self.mfm.quote_provider = StaticQuoteProvider({symbol: 100.0 for symbol in usd_symbols})
+        self.assertTrue(self.mfm.update_stocks_price(),
+                        msg='Failed to update all stocks prices with offline quotes')
+        self.assertEqual(self.mfm.quote_provider.requests_count, 1,
+                         msg='Expected one batched quote request for all USD symbols')
+
+    def test_derived_on_read_matches_stored_values(self):
+        usd_symbols = self.mfm.db.stocks.get_stocks_names(currency='USD') + ['FREE']
+        self.mfm.quote_provider = StaticQuoteProvider({symbol: 100.0 for symbol in usd_symbols})
+        self.mfm._get_redemption_prices = lambda fund_ids: {fund_id: 10000.0 for fund_id in fund_ids}
+        self.mfm.refresh_fx = lambda: FxSnapshot({('USD', 'ILS'): 3.5})
+        self.mfm.add_stock('FREE', '18.12.2011', 10, 0, 'USD')  # zero buy price, no profit percentage
+
+        def free_lot_profit_percentage():
+            return next(d['Profit_%'] for d in self.mfm.db.stocks.fetch_data_for_df() if d['Symbol'] == 'FREE')
+
+        self.mfm.update_stocks_price()
+        stored = self.mfm.db.portfolio_summary()
+        self.assertIsNone(free_lot_profit_percentage())
+        try:
+            mongo_db._Stocks.derived_on_read = True
+            self.mfm.update_stocks_price()
+            self.assertEqual(self.mfm.db.quotes.collection.count_documents({}),
+                             len(self.mfm.db.stocks.get_stocks_names()), msg='Expected one quote per symbol')
+            derived = self.mfm.db.portfolio_summary()
+            self.assertIsNone(free_lot_profit_percentage())
+        finally:
+            mongo_db._Stocks.derived_on_read = False
+
+        for key in ['Market_Value_ILS', 'Market_Value_USD', 'Profit_ILS', 'Profit_USD']:
+            self.assertAlmostEqual(stored[key], derived[key], places=2, msg=key)
+
+    def test_derived_on_read_saved_in_database(self):
+        try:
+            mongo_db.MyMongoDB(derived_on_read=True)
+            self.assertTrue(mongo_db.MyMongoDB().stocks.derived_on_read, msg='Mode should be read from database')
+        finally:
+            mongo_db.MyMongoDB(derived_on_read=False)
+
+    def test_portfolio_totals_follow_writes(self):
+        self.mfm.quote_provider = StaticQuoteProvider({'BNDX': 70.0})
+        self.mfm.refresh_fx = lambda: FxSnapshot({('USD', 'ILS'): 3.5})
+        self.mfm.add_stock('BNDX', '18.12.2011', 150, 66.5, 'USD')
+        self.mfm.remove_stock('BNDX', 50)
+        self.mfm.update_bank_trader_foreign_currency('USD', u_trader_usd_val=1000)
+
+        self.assertEqual(self.mfm.db.totals.check_drift(), {},
+                         msg='Totals kept with $inc should equal a full recompute')
+
     def test_update_bank_trader(self):
         self.assertTrue(self.mfm.update_bank_trader_cf(60, 50),
                         msg='Failed to update bank and trader cash flows')
 
+    def test_cached_views_invalidated_on_write(self):
+        assets = self.mfm.df_assets(to_email=True, plain_text=True)
+        self.assertEqual(assets, self.mfm.df_assets(to_email=True, plain_text=True))
+
+        revision = mongo_db.MyMongoDB.revision
+        self.mfm.update_bank_trader_cf(u_bank_cf=123456.78)
+        self.assertGreater(mongo_db.MyMongoDB.revision, revision, msg='Write did not change revision')
+        self.assertIn('123,456.78', self.mfm.df_assets(to_email=True, plain_text=True),
+                      msg='Cached assets not invalidated after write')
+
     def test_update_history_data(self):
         self.assertTrue(self.mfm.update_history_data(),
                         msg='Failed to update all history data')
@@ -77,5 +198,343 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(self.mfm.send_fancy_email(receiver_email))
 
 
+class PipelineTestCase(unittest.TestCase):
+
+    def test_failed_stage_skips_dependents(self):
+        def fail():
+            raise RuntimeError('scraper failed')
+
+        run = Pipeline([
+            Stage('prices', lambda: 1),
+            Stage('bank', fail),
+            Stage('graphs', lambda prices: prices + 1, depends_on=['prices']),
+            Stage('history', lambda prices, bank: None, depends_on=['prices', 'bank']),
+        ]).run()
+
+        self.assertEqual(run.results, {'prices': 1, 'graphs': 2})
+        self.assertEqual(list(run.errors), ['bank'])
+        self.assertEqual(run.skipped, ['history'])
+        self.assertEqual(run.critical_path[0], 'prices')
+
+    def test_dependency_cycle(self):
+        with self.assertRaises(ValueError):
+            Pipeline([Stage('a', lambda b: b, depends_on=['b']), Stage('b', lambda a: a, depends_on=['a'])])
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def test_breaker_opens_and_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker('stub', failure_threshold=2, cooldown=60, negative_ttl=30, clock=lambda: now[0])
+
+        breaker.record_failure(5110788)
+        self.assertFalse(breaker.allow(5110788), msg='Failed symbol should be negative cached')
+        self.assertTrue(breaker.allow(5109889))
+
+        breaker.record_failure(5109889)
+        self.assertFalse(breaker.allow(), msg='Breaker should open after failure threshold')
+
+        now[0] = 61
+        self.assertTrue(breaker.allow(), msg='One trial request after cooldown')
+        self.assertFalse(breaker.allow(), msg='Only one trial request while half open')
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow(5110788), msg='Negative cache entry should expire')
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_token_bucket_queue_wait(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        bucket = TokenBucket('stub', rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([bucket.acquire() for _ in range(4)], [0.0, 0.0, 0.5, 0.5],
+                         msg='Burst should pass at once, then one request per 1 / rate seconds')
+        now[0] += 10
+        self.assertEqual(bucket.acquire(), 0.0, msg='Bucket should refill only up to burst')
+
+        async def burst():
+            return await asyncio.gather(*[bucket.acquire_async() for _ in range(3)])
+
+        bucket.clock = time.monotonic
+        bucket.rate, bucket.tokens, bucket.updated_at = 100, 1, time.monotonic()
+        waits = asyncio.run(burst())
+        self.assertEqual(waits[0], 0.0)
+        self.assertAlmostEqual(waits[2], 0.02, delta=0.005, msg='Async tasks should queue in order')
+        self.assertEqual(bucket.stats()['waited'], 4)
+
+
+class _StubBizPortalHandler(BaseHTTPRequestHandler):
+    """BizPortal GetQuote stub, redemption price is fund id * 100, fund 0 fails, fund 1 fails on first request"""
+    requested = []
+
+    def do_GET(self):
+        fund_id = int(parse_qs(urlparse(self.path).query)['id'][0])
+        self.requested.append(fund_id)
+        if fund_id == 0 or (fund_id == 1 and self.requested.count(1) == 1):  # fund 1 fails once
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({'Quote': {'RedPrice': str(fund_id * 100)}}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class QuotesTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubBizPortalHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/GetQuote?id={{fund_id}}'
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_redemption_prices_concurrent_fetch(self):
+        _StubBizPortalHandler.requested.clear()
+        provider = BizPortalQuoteProvider(max_concurrency=2, timeout=5, url=self.url, retries=2, backoff_factor=0)
+        prices = provider.get_prices([5110788, 5109889, 5110788, 0, 1])
+        provider.close()
+
+        self.assertEqual(prices, {5110788: 511078800.0, 5109889: 510988900.0, 1: 100.0},
+                         msg='Failed funds should be left out of prices')
+        self.assertEqual(sorted(_StubBizPortalHandler.requested), [0, 0, 0, 1, 1, 5109889, 5110788],
+                         msg='Duplicate funds should be fetched once, errors retried')
+
+    def test_hedged_request_to_alternate_source(self):
+        delays = {'primary': 0.01, 'alternate': 0.05}
+
+        def fake_source(name):
+            def get_price(symbol):
+                time.sleep(delays[name])
+                return f'{name}:{symbol}'
+            return get_price
+
+        router = QuoteRouter({'primary': fake_source('primary'), 'alternate': fake_source('alternate')},
+                             min_samples=5, default_hedge_delay=10)
+        for _ in range(5):
+            self.assertEqual(router.get_price('A'), 'primary:A')
+        self.assertEqual(router.hedged_count, 0, msg='Primary within its p95 should not be hedged')
+
+        delays['primary'] = 1.0
+        t0 = time.perf_counter()
+        self.assertEqual(router.get_price('A'), 'alternate:A')
+        self.assertLess(time.perf_counter() - t0, 0.5, msg='Slow primary should be hedged after its p95')
+        self.assertEqual(router.hedged_count, 1)
+
+    def test_failing_source_not_ranked_first(self):
+        def failing(symbol):
+            raise ConnectionError('circuit open')
+
+        router = QuoteRouter({'failing': failing, 'working': lambda symbol: 1.0}, min_samples=1)
+        for _ in range(3):
+            self.assertEqual(router.get_price('A'), 1.0)
+        self.assertEqual(len(router.histograms['failing']), 0, msg='Failures should not be recorded as latencies')
+
+    def test_cached_prices_shared_between_processes(self):
+        # monday 2020-01-06 10:00 in Tel Aviv, TASE is open.
+        now = [datetime.datetime(2020, 1, 6, 8, tzinfo=datetime.timezone.utc).timestamp()]
+        with tempfile.TemporaryDirectory() as path:
+            cache_file = os.path.join(path, 'quotes.sqlite3')
+            _StubBizPortalHandler.requested.clear()
+            first = BizPortalQuoteProvider(url=self.url, cache=QuoteCache(cache_file, clock=lambda: now[0]))
+            self.assertEqual(first.get_prices([5110788]), {5110788: 511078800.0})
+
+            # new cache object on same file, like a restarted GUI.
+            second = BizPortalQuoteProvider(url=self.url, cache=QuoteCache(cache_file, clock=lambda: now[0]))
+            self.assertEqual(second.get_prices([5110788, 5109889]), {5110788: 511078800.0, 5109889: 510988900.0})
+            self.assertEqual(sorted(_StubBizPortalHandler.requested), [5109889, 5110788],
+                             msg='Fresh cached fund should not be requested again')
+
+            now[0] += 600  # market open, older than open_ttl
+            self.assertEqual(second.cache.get_many('bizportal', [5110788]), {})
+            now[0] += 5 * 24 * 3600  # saturday, market closed since friday close
+            self.assertEqual(second.cache.get_many('bizportal', [5110788]), {})
+            second.get_prices([5110788])
+            now[0] += 24 * 3600  # sunday, stored after last close
+            self.assertEqual(second.cache.get_many('bizportal', [5110788]), {5110788: 511078800.0})
+
+
+class _FakeHistorySource:
+    def __init__(self):
+        self.requested = []
+
+    def get_history(self, symbols, start):
+        self.requested.append((sorted(symbols), start))
+        dates = np.arange(np.datetime64(start, 'D'), np.datetime64('2020-01-11'))
+        return {symbol: (dates, np.arange(len(dates), dtype=float) + dates.astype(int) % 100) for symbol in symbols}
+
+
+class PriceHistoryTestCase(unittest.TestCase):
+
+    def test_backfill_then_missing_days_only(self):
+        source = _FakeHistorySource()
+        with tempfile.TemporaryDirectory() as path:
+            store = PriceHistoryStore(path, source=source, backfill_days=5)
+            self.assertEqual(store.sync(['VTI'], today=datetime.date(2020, 1, 6)), {'VTI': 5})
+            self.assertEqual(store.sync(['VTI'], today=datetime.date(2020, 1, 6)), {},
+                             msg='Synced symbol should not be downloaded again')
+
+            self.assertEqual(store.sync(['VTI'], today=datetime.date(2020, 1, 9)), {'VTI': 3})
+            self.assertEqual(source.requested[-1], (['VTI'], datetime.date(2020, 1, 6)))
+            self.assertEqual(str(store.last_date('VTI')), '2020-01-08', msg='Today close should not be stored')
+
+            dates, closes = store.window('VTI', '2020-01-03', '2020-01-05')
+            self.assertIsInstance(closes, np.memmap, msg='Window should be a slice of the memory-mapped file')
+            self.assertEqual(len(dates), 3)
+            self.assertEqual(store.close_on('VTI', '2020-01-04'), closes[1])
+
+
+class _FakeHistoryData:
+    def __init__(self, records: list):
+        self.records = records
+        self.starts = []
+
+    def fetch_data_for_df(self, start=None):
+        self.starts.append(start)
+        return [r for r in self.records if start is None or r['Date'] >= start][::-1]
+
+    def count(self):
+        return len(self.records)
+
+    def fingerprint(self, columns):
+        return {'count': len(self.records),
+                **{column: sum(r.get(column) or 0 for r in self.records) for column in columns}}
+
+
+class HistoryStoreTestCase(unittest.TestCase):
+
+    def test_sync_appends_and_replaces_last_day(self):
+        records = [{'Date': datetime.datetime(2020, 1, day), 'Total_ILS': float(day), 'Bank_CF': None}
+                   for day in range(1, 6)]
+        history_data = _FakeHistoryData(records)
+        with tempfile.TemporaryDirectory() as path:
+            store = HistoryStore(path)
+            self.assertEqual(store.sync(history_data), 5)
+
+            records[-1]['Total_ILS'] = 50.0  # today record updated during the day
+            records.append({'Date': datetime.datetime(2020, 1, 6), 'Total_ILS': 6.0})
+            self.assertEqual(store.sync(history_data), 2)
+            self.assertEqual(history_data.starts[-1], datetime.datetime(2020, 1, 5))
+
+            df = store.frame()
+            self.assertEqual(list(df.Total_ILS), [6.0, 50.0, 4.0, 3.0, 2.0, 1.0], msg='Latest day should be first')
+            self.assertTrue(df.Bank_CF.isna().all())
+            self.assertEqual(len(store.frame(start='2020-01-02', end='2020-01-03')), 2)
+            self.assertEqual(list(store.frame(limit=2).Total_ILS), [6.0, 50.0])
+
+            records.insert(0, {'Date': datetime.datetime(2019, 12, 31), 'Total_ILS': 0.0})  # imported later
+            self.assertEqual(store.sync(history_data), 7, msg='Mirror missing earlier records should be rebuilt')
+            self.assertEqual(str(store.dates()[0]), '2019-12-31')
+
+    def test_sync_follows_revision_and_past_day_edits(self):
+        records = [{'Date': datetime.datetime(2020, 1, day), 'Total_ILS': float(day)} for day in range(1, 4)]
+        history_data = _FakeHistoryData(records)
+        with tempfile.TemporaryDirectory() as path:
+            store = HistoryStore(path)
+            self.assertEqual(store.sync(history_data, revision=1), 3)
+            df = store.frame()  # mapped files of this generation stay valid after later writes
+
+            records[0]['Total_ILS'] = 10.0  # past day restored, same count
+            self.assertEqual(store.sync(history_data, revision=1), 0, msg='Same revision should not be synced')
+            self.assertEqual(store.sync(history_data, revision=2), 3, msg='Past day edit should rebuild mirror')
+            self.assertEqual(list(store.frame().Total_ILS), [3.0, 2.0, 10.0])
+            self.assertEqual(list(df.Total_ILS), [3.0, 2.0, 1.0])
+            self.assertEqual(len([name for name in os.listdir(path) if name.isdigit()]), 2,
+                             msg='Only current and previous generations should be kept')
+
+    def test_history_window_matched_and_limited_on_server(self):
+        start = datetime.datetime(2020, 1, 1)
+        pipeline = mongo_db._HistoryData()._df_pipeline(start=start, limit=7)
+        self.assertEqual(pipeline[0], {'$match': {'date': {'$gte': start}}})
+        self.assertEqual(pipeline[1:3], [{'$sort': {'date': -1}}, {'$limit': 7}],
+                         msg='Limit should keep latest records, before projection')
+
+
+class JsonStreamTestCase(unittest.TestCase):
+    text = json.dumps({
+        'stocks': {'BRK.B US': {'Lot_1': {'Date': '01.02.2020', 'Amount': 12345.678, 'Buy_Price': -1.5e3,
+                                          'note': 'a {brace} "quoted" } text'}}},
+        'nested': {'x': [1, {'y': {'z': [True, None, 'a,b:c']}}], 'empty': {}},
+        'history_data': {'01.01.2020': {'bank_cf': 1, 'market_value': {'portfolio': [2, 3],
+                                                                       'total_assets': [4, 5]},
+                                        'profit': [6, 7], 'trader_cf': 8}},
+    })
+
+    def test_values_split_across_reads(self):
+        stream = JsonStream(io.StringIO(self.text), chunk_size=3)
+        parsed = {}
+        for key in stream.members():
+            if key == 'stocks':
+                parsed[key] = {symbol: stream.value() for symbol in stream.members()}
+            else:
+                parsed[key] = stream.value()
+        self.assertEqual(parsed, json.loads(self.text))
+
+    def test_symbols_and_dates_keys_cleaned(self):
+        requests = dict(read_requests(JsonStream(io.StringIO(self.text), chunk_size=3)))
+        self.assertEqual(requests['stocks']._filter, {'symbol': 'BRK/B_US', 'Lot_Num': 1},
+                         msg='Symbols should be cleaned like imports of old versions')
+        self.assertEqual(requests['history_data']._filter, {'date': datetime.datetime(2020, 1, 1)})
+
+
+class _FakeCursor(list):
+    def batch_size(self, size):
+        return self
+
+
+class ExportTestCase(unittest.TestCase):
+    # TASE_INDEX is a fund number in some lots and a currency in others, Note only appears in a later batch.
+    docs = [{'_id': ObjectId(), 'symbol': 'PSAGOT', 'Lot_Num': 1, 'TASE_INDEX': 5110788,
+             'Date': datetime.datetime(2020, 1, 2), 'Amount': 300, 'Buy_Price': 1950.58},
+            {'_id': ObjectId(), 'symbol': 'DOLLAR', 'Lot_Num': 1, 'TASE_INDEX': 'USD',
+             'Date': datetime.datetime(2020, 1, 3), 'Amount': 1000, 'Buy_Price': 350.0},
+            {'_id': ObjectId(), 'symbol': 'VTI', 'Lot_Num': 1, 'TASE_INDEX': None,
+             'Date': datetime.datetime(2020, 1, 4), 'Amount': 10, 'Buy_Price': 150.5, 'Note': 'gift'}]
+
+    class _Collection:
+        def __init__(self, docs):
+            self.docs = docs
+
+        def find(self, query):
+            return _FakeCursor(dict(doc) for doc in self.docs)
+
+    def test_ndjson_round_trip(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, 'stocks.ndjson')
+            self.assertEqual(export_ndjson(self._Collection(self.docs), file_path, batch_size=2), 3)
+            requests = list(read_ndjson_requests(file_path))
+
+        self.assertEqual({name for name, _ in requests}, {'stocks'})
+        self.assertEqual([request._doc for _, request in requests], self.docs,
+                         msg='Documents should be imported back with their types')
+
+    def test_parquet_round_trip(self):
+        import pyarrow.parquet as pq
+
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, 'stocks.parquet')
+            self.assertEqual(export_parquet(self._Collection(self.docs), file_path, batch_size=2), 3)
+            self.assertEqual(pq.ParquetFile(file_path).metadata.num_row_groups, 2,
+                             msg='Expected one row group per batch')
+            rows = pq.read_table(file_path).to_pylist()
+
+        self.assertEqual([row['TASE_INDEX'] for row in rows], ['5110788', 'USD', None],
+                         msg='Mixed str and number fields should be written as strings')
+        self.assertEqual([row['Note'] for row in rows], [None, None, 'gift'])
+        self.assertEqual([row['_id'] for row in rows], [str(doc['_id']) for doc in self.docs])
+        self.assertEqual([(row['Date'], row['Amount'], row['Buy_Price']) for row in rows],
+                         [(doc['Date'], doc['Amount'], doc['Buy_Price']) for doc in self.docs])
+
+
 if __name__ == '__main__':
     unittest.main()